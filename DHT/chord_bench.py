@@ -0,0 +1,48 @@
+"""
+Chord Benchmark
+
+Measures how long a ChordNode join takes as the ring grows.
+All nodes run inside this process on their usual TEST_BASE+n ports,
+so run it when no other chord nodes are up:
+python3 chord_bench.py [RING_SIZE]
+
+:Authors: Noha Nomier
+"""
+import os
+import random
+import sys
+import time
+
+from chord_node import ChordNode, NODES
+
+
+def bench_join(ring_size):
+    """
+    Joins @ring_size nodes one at a time in random order through the first node
+    and returns a list of (nodes already in the ring, join seconds)
+    """
+    ids = random.sample(range(NODES), ring_size)
+    first = ChordNode(ids[0])
+    first.join()
+    timings = []
+    for count, node_id in enumerate(ids[1:], start=1):
+        node = ChordNode(node_id)
+        start = time.perf_counter()
+        node.join(first.node)
+        timings.append((count, time.perf_counter() - start))
+    return timings
+
+
+if __name__ == '__main__':
+    ring_size = int(sys.argv[1]) if len(sys.argv) > 1 else NODES
+    if not 1 < ring_size <= NODES:
+        print(f"Ring size must be between 2 and {NODES}")
+        exit(1)
+
+    timings = bench_join(ring_size)
+    print("ring size\tjoin (ms)")
+    for count, seconds in timings:
+        print(f"{count}\t\t{seconds * 1000:.2f}")
+    # listener threads never return, so leave without waiting for them
+    sys.stdout.flush()
+    os._exit(0)
@@ -13,16 +13,28 @@ Run python3 chord_node.py [new_node_id] [existing_node_id]
 
 :Authors: Noha Nomier
 """
+import logging
 import pickle
 import threading
 import socket
 import sys
+import time
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from chord_query import recv_all
+from chord_store import ShardedStore
 
 M = 4  # FIXME: Test environment, normally = hashlib.sha1().digest_size * 8
 NODES = 2**M
 BUF_SZ = 4096  # socket recv arg
 BACKLOG = 100  # socket listen arg
 TEST_BASE = 43544  # for testing use port numbers on localhost at TEST_BASE+n
+JOIN_WORKERS = 8  # max concurrent RPCs issued while joining
+CACHE_SIZE = 1024  # max entries in each of the entry node read caches
+CACHE_TTL = 30  # seconds a cached owner or row is trusted
+LOG_LEVEL = logging.INFO  # set to logging.DEBUG to trace every RPC and stored key
+
+logger = logging.getLogger('chord_node')
 
 NOT_FOUND_MSG = "KEY DOESN'T EXIST"
 
@@ -38,6 +50,12 @@ PUT_DATA = 'put_data'
 UPDATE_KEYS = 'update_keys'
 FIND_DATA = 'find_data'
 GET_VALUE = 'get_value'
+GET_VERSIONED_VALUE = 'get_versioned_value'
+QUERY_INDEX = 'query_index'
+SCATTER_QUERY = 'scatter_query'
+STATS = 'stats'
+
+NOT_INDEXED_MSG = "COLUMN ISN'T INDEXED"
 
 class ModRange(object):
     """
@@ -149,17 +167,121 @@ class FingerEntry(object):
         return id in self.interval
 
 
+class LRUCache(object):
+    """
+    Thread-safe bounded LRU mapping whose entries expire @ttl seconds after being put.
+
+    >>> cache = LRUCache(2, 60)
+    >>> cache.put('a', 1); cache.put('b', 2); cache.get('a')
+    1
+    >>> cache.put('c', 3); cache.get('b') is None  # b was least recently used
+    True
+    >>> expired = LRUCache(2, 0)
+    >>> expired.put('a', 1); expired.get('a') is None
+    True
+    """
+    def __init__(self, maxsize, ttl):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.entries = OrderedDict()  # key -> (expiry, value), oldest first
+        self.lock = threading.Lock()
+
+    def get(self, key):
+        """returns the cached value for @key or None if missing or expired"""
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is None:
+                return None
+            if entry[0] <= time.monotonic():
+                del self.entries[key]
+                return None
+            self.entries.move_to_end(key)
+            return entry[1]
+
+    def put(self, key, value):
+        """caches @value under @key, evicting the least recently used entry if full"""
+        if self.maxsize <= 0:
+            return
+        with self.lock:
+            self.entries[key] = (time.monotonic() + self.ttl, value)
+            self.entries.move_to_end(key)
+            if len(self.entries) > self.maxsize:
+                self.entries.popitem(last=False)
+
+    def pop(self, key):
+        """drops @key from the cache if it is there"""
+        with self.lock:
+            self.entries.pop(key, None)
+
+
+class NodeStats(object):
+    """
+    Counters kept by a ChordNode about the RPCs it serves and makes.
+    Latencies and hop counts are kept as histograms with power of two buckets,
+    e.g. a 300us RPC is counted in the 512 bucket.
+
+    >>> stats = NodeStats()
+    >>> stats.record_rpc('successor', 0.0003); stats.record_hops(2); stats.record_hops(2)
+    >>> stats.served['successor'], stats.latency_us['successor'], stats.hops
+    (1, {512: 1}, {2: 2})
+    """
+    def __init__(self):
+        self.served = {}  # method -> RPCs served
+        self.latency_us = {}  # method -> {bucket upper bound in microseconds: count}
+        self.called = {}  # method -> RPCs sent to other nodes
+        self.hops = {}  # RPC hops per find_predecessor lookup -> count
+        self.lock = threading.Lock()
+
+    @staticmethod
+    def bucket(value):
+        """smallest power of two that is >= @value"""
+        return 1 << max(0, int(value) - 1).bit_length()
+
+    def record_rpc(self, method, seconds):
+        """counts one served @method RPC that took @seconds"""
+        bucket = self.bucket(seconds * 1_000_000)
+        with self.lock:
+            self.served[method] = self.served.get(method, 0) + 1
+            histogram = self.latency_us.setdefault(method, {})
+            histogram[bucket] = histogram.get(bucket, 0) + 1
+
+    def record_call(self, method):
+        """counts one @method RPC sent to another node"""
+        with self.lock:
+            self.called[method] = self.called.get(method, 0) + 1
+
+    def record_hops(self, hops):
+        """counts one lookup that needed @hops RPC hops"""
+        with self.lock:
+            self.hops[hops] = self.hops.get(hops, 0) + 1
+
+    def snapshot(self):
+        """returns a copy of all the counters that is safe to send over an RPC"""
+        with self.lock:
+            return {
+                'served': dict(self.served),
+                'latency_us': {method: dict(histogram) for method, histogram in self.latency_us.items()},
+                'called': dict(self.called),
+                'hops': dict(self.hops),
+            }
+
+
 class ChordNode():
     """
     An object that represents a node in a Chord P2P system 
     that makes RPC to other nodes by the assistance of its finger 
     table and stores keys some keys that exceed K/N
     """
-    def __init__(self, n):
+    def __init__(self, n, cache_size=CACHE_SIZE, cache_ttl=CACHE_TTL):
         self.node = n
         self.finger = [None] + [FingerEntry(n, k) for k in range(1, M+1)]  # indexing starts at 1
         self.predecessor = None
-        self.keys = {}
+        self.keys = ShardedStore()  # rows this node is responsible for, safe to share between RPC threads
+        self.versions = {}  # hashed_id -> version, bumped on every update of that id's keys
+        self.versions_lock = threading.Lock()
+        self.owner_cache = LRUCache(cache_size, cache_ttl)  # hashed_id -> (owner node, latest version seen from it)
+        self.row_cache = LRUCache(cache_size, cache_ttl)  # (hashed_id, key) -> (version, row)
+        self.stats = NodeStats()
         self.address = ('localhost', TEST_BASE + n)
         self.listener = self.start_server(self.address) 
         self.start_listening()
@@ -173,7 +295,7 @@ class ChordNode():
 
     def start_listening(self):
         """Starts a new listener thread"""
-        print("Starting a listening thread at {}".format(self.address))
+        logger.info("Starting a listening thread at %s", self.address)
         listen_thr = threading.Thread(target=self.listen, args=())
         listen_thr.start()
 
@@ -196,7 +318,7 @@ class ChordNode():
 
     def find_successor(self, id):
         """ Ask this node to find id's successor = successor(predecessor(id))"""
-        print(f"node {self.node}: finding successor of {id}...")
+        logger.debug("node %s: finding successor of %s...", self.node, id)
         np = self.find_predecessor(id)
         return self.call_rpc(np, SUCCESSOR)
     
@@ -205,13 +327,14 @@ class ChordNode():
         This method handles calling an RPC to another node by sending @n_prime
         the required method to be executed on that node and the associated parameters
         """
-        print(f"Self: Calling RPC to {n_prime}  with method = {method} and args {(arg1,arg2)}")
+        logger.debug("Self: Calling RPC to %s with method = %s and args %s", n_prime, method, (arg1, arg2))
+        self.stats.record_call(method)
         address = ('localhost', TEST_BASE+n_prime)
         with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as sock:
             try:
                 sock.connect(address)
                 sock.sendall(pickle.dumps((method, arg1, arg2)))
-                return pickle.loads(sock.recv(BUF_SZ))
+                return pickle.loads(recv_all(sock))
             except Exception as e:
                 return None
 
@@ -228,36 +351,45 @@ class ChordNode():
                 self.finger[i].node = self.node
             self.predecessor = self.node
         else:
-            print(f"Initializing Finger Table with the help of node {n_prime}\n\n")
+            logger.info("Initializing Finger Table with the help of node %s", n_prime)
             self.init_finger_table(n_prime)
             self.update_others()
 
         self.pr_finger_table()
 
     def pr_finger_table(self):
-        """Prints node's finger table"""
-        print("*"*30)
-        print(f"Node {self.node} finger table:\n")
-        print("start\tint.\t\tsucc.\n")
+        """Logs node's finger table"""
+        if not logger.isEnabledFor(logging.INFO):
+            return
+        lines = ["*"*30, f"Node {self.node} finger table:\n", "start\tint.\t\tsucc.\n"]
         for i in range(1, M+1):
-            print(f"{i}: {self.finger[i].start} | [{self.finger[i].start}, {self.finger[i].next_start}) | {self.finger[i].node}")
-        print(f"\nPREDECESSOR:{self.predecessor}\nSUCCESSOR:{self.successor}")
-        print("*"*30)
-        print("\n")
+            lines.append(f"{i}: {self.finger[i].start} | [{self.finger[i].start}, {self.finger[i].next_start}) | {self.finger[i].node}")
+        lines.append(f"\nPREDECESSOR:{self.predecessor}\nSUCCESSOR:{self.successor}")
+        lines.append("*"*30)
+        logger.info("\n".join(lines))
 
     def init_finger_table(self, n_prime):
         """
         A method to initialize finger table with the help of one other node @n_prime
-        by calling RPC to @n_prime to update each finger table entry
+        by calling RPC to @n_prime to update each finger table entry.
+        Once the successor is known, every finger starting before it is the successor
+        itself, the remaining lookups are independent so they are issued concurrently
         """
         self.finger[1].node = self.call_rpc(n_prime, FIND_SUCCESSOR, self.finger[1].start)
         self.predecessor = self.call_rpc(self.successor, GET_PREDECESSOR) # this should be successor.predecessor
         self.call_rpc(self.successor, SET_PREDECESSOR, self.node)
-        for i in range(1, M):
-            if self.finger[i+1].start in ModRange(n, self.finger[i].node, NODES):
-                self.finger[i+1].node = self.finger[i].node
+
+        remote = []
+        for i in range(2, M+1):
+            if self.finger[i].start in ModRange(self.node, self.successor, NODES):
+                self.finger[i].node = self.successor
             else:
-                self.finger[i+1].node = self.call_rpc(n_prime, FIND_SUCCESSOR, self.finger[i+1].start)
+                remote.append(i)
+
+        with ThreadPoolExecutor(max_workers=JOIN_WORKERS) as pool:
+            successors = pool.map(lambda i: self.call_rpc(n_prime, FIND_SUCCESSOR, self.finger[i].start), remote)
+            for i, successor in zip(remote, successors):
+                self.finger[i].node = successor
 
     def put_data(self, key, value):
         """
@@ -266,13 +398,16 @@ class ChordNode():
         its end adds the required @key,@value to their stored keys
         """
         successor_node = self.find_successor(key)
-        self.call_rpc(successor_node, UPDATE_KEYS, key, value)
+        version = self.call_rpc(successor_node, UPDATE_KEYS, key, value)
+        if version is not None:
+            # a newer version makes any row this node cached for @key stale
+            self.owner_cache.put(key, (successor_node, version))
         self.pr_keys()
 
     def pr_keys(self):
-        """prints the keys stored on this node"""
-        print("*"*30)
-        print(f"Keys Stored on this node: {self.keys.keys()}\n")
+        """logs the keys stored on this node, only when debugging since it lists all of them"""
+        if logger.isEnabledFor(logging.DEBUG):
+            logger.debug("Keys Stored on this node: %s", self.keys.hashed_ids())
         
     def get_predecessor(self):
         """returns node's predecessor"""
@@ -290,7 +425,9 @@ class ChordNode():
         """
         rpc = client.recv(BUF_SZ)
         method, arg1, arg2 = pickle.loads(rpc)
+        start = time.perf_counter()
         result = self.dispatch_rpc(method, arg1, arg2)
+        self.stats.record_rpc(method, time.perf_counter() - start)
         if result != None:
             client.sendall(pickle.dumps(result))
         client.close()
@@ -318,70 +455,160 @@ class ChordNode():
         elif method == PUT_DATA:
             self.put_data(arg1, arg2)
         elif method == UPDATE_KEYS:
-            self.update_keys(arg1, arg2)
+            return self.update_keys(arg1, arg2)
         elif method == FIND_DATA:
             return self.find_data(arg1, arg2)
         elif method == GET_VALUE:
             return self.get_value(arg1, arg2)
+        elif method == GET_VERSIONED_VALUE:
+            return self.get_versioned_value(arg1, arg2)
+        elif method == QUERY_INDEX:
+            return self.query_index(arg1, arg2)
+        elif method == SCATTER_QUERY:
+            return self.scatter_query(arg1, arg2)
+        elif method == STATS:
+            return self.get_stats()
         else:
-            print(f"Received invalid request {method} with args: {(arg1, arg2)}")
+            logger.warning("Received invalid request %s with args: %s", method, (arg1, arg2))
 
     def find_data(self, hashed_id, key):
+        """
+        Looks up @key on the node owning @hashed_id. The owner and the returned row are
+        cached on this node and a cached row is answered locally, without asking the owner,
+        as long as its version matches the latest one this node has seen for @hashed_id.
+        Versions only arrive with replies this node gets anyway (its own updates and
+        lookups), so an update made through another node shows up here once the cached
+        entries expire, after at most cache_ttl seconds
+        """
         if hashed_id>NODES:
             return NOT_FOUND_MSG
-        successor_node = self.find_successor(hashed_id)
-        return self.call_rpc(successor_node, GET_VALUE, hashed_id, key)
+        cached_owner = self.owner_cache.get(hashed_id)
+        if cached_owner is not None:
+            successor_node, version = cached_owner
+            cached_row = self.row_cache.get((hashed_id, key))
+            if cached_row is not None and cached_row[0] == version:
+                return cached_row[1]
+        else:
+            successor_node = self.find_successor(hashed_id)
+
+        reply = self.call_rpc(successor_node, GET_VERSIONED_VALUE, hashed_id, key)
+        if reply is None and cached_owner is not None:
+            # the cached owner may have left the ring, look it up again
+            self.owner_cache.pop(hashed_id)
+            successor_node = self.find_successor(hashed_id)
+            reply = self.call_rpc(successor_node, GET_VERSIONED_VALUE, hashed_id, key)
+        if reply is None:
+            return None
+
+        version, value = reply
+        self.owner_cache.put(hashed_id, (successor_node, version))
+        if value != NOT_FOUND_MSG:
+            self.row_cache.put((hashed_id, key), (version, value))
+        return value
+
+    def get_versioned_value(self, hashed_id, key):
+        """returns (version, value) for @key so callers can tell when their copy is stale"""
+        with self.versions_lock:
+            version = self.versions.get(hashed_id, 0)
+        return version, self.get_value(hashed_id, key)
 
     def get_value(self, hashed_id, key):
-        if hashed_id not in self.keys:
-            print(f"self: key {key} doesn't exist")
-            return NOT_FOUND_MSG
-        
-        entries_for_hash = self.keys[hashed_id]
-
-        if key not in entries_for_hash:
-            print(f"self: key {key} doesn't exist")
+        row = self.keys.get(hashed_id, key)
+        if row is None:
+            logger.debug("self: key %s doesn't exist", key)
             return NOT_FOUND_MSG
         
-        print(f"returning value for id {hashed_id} and key {key} .....")
-        return entries_for_hash[key]
+        logger.debug("returning value for id %s and key %s .....", hashed_id, key)
+        return row
         
+    def get_stats(self):
+        """returns this node's RPC counters together with what it stores"""
+        stats = self.stats.snapshot()
+        stats.update({
+            'node': self.node,
+            'keys': len(self.keys),
+            'hashed_ids': self.keys.hashed_ids(),
+            'bytes_stored': self.keys.nbytes(),
+        })
+        return stats
+
+    def query_index(self, column, value):
+        """returns the rows stored on this node whose @column equals @value"""
+        try:
+            return self.keys.query(column, value)
+        except KeyError:
+            return NOT_INDEXED_MSG
+
+    def scatter_query(self, column, value):
+        """
+        Asks every node in the ring for its rows whose @column equals @value
+        concurrently and merges the partial results into one list
+        """
+        nodes = self.ring_nodes()
+        with ThreadPoolExecutor(max_workers=JOIN_WORKERS) as pool:
+            partials = list(pool.map(lambda node: self.call_rpc(node, QUERY_INDEX, column, value), nodes))
+        if NOT_INDEXED_MSG in partials:
+            return NOT_INDEXED_MSG
+        rows = []
+        for partial in partials:
+            if partial is not None:
+                rows.extend(partial)
+        return sorted(rows)
+
+    def ring_nodes(self):
+        """returns every node in the ring by walking successors starting from this node"""
+        nodes = [self.node]
+        node = self.successor
+        while node is not None and node != self.node and len(nodes) < NODES:
+            nodes.append(node)
+            node = self.call_rpc(node, SUCCESSOR)
+        return nodes
+
     def update_keys(self, key, value):
-        entries = {}
-        if key in self.keys.keys():
-           entries = self.keys[key]      
-        entries.update(value)
-        self.keys[key] = entries  
+        """stores the {original key: row} entries in @value under @key and returns its new version"""
+        self.keys.put_many(key, value)
+        with self.versions_lock:
+            version = self.versions[key] = self.versions.get(key, 0) + 1
         self.pr_keys()
+        return version
         
     def find_predecessor(self, id):
         """
         We are looking for n' such that id falls between n' and the successor for n'
         """
         n_prime = self.node
-        # print(f"n_prime successor {n_prime_successor}")
+        hops = 0
         while id not in ModRange(n_prime+1, self.call_rpc(n_prime, SUCCESSOR)+1, NODES):
             n_prime = self.call_rpc(n_prime, CLOSEST_PRECEDING_FINGER, id)
+            hops += 1
+        self.stats.record_hops(hops)
         return n_prime
 
     def closest_preceding_finger(self, id):
         for i in reversed(range(1, M+1)): #M+1 because finger table is 1-indexed
-            if self.finger[i].node in ModRange(n+1, id, NODES): 
+            if self.finger[i].node in ModRange(self.node+1, id, NODES): 
                 return self.finger[i].node
         return self.node
     
     def update_others(self):
-        """ Update all other node that should have this node in their finger tables """
-        for i in range(1, M+1):  # find last node p whose i-th finger might be this node
+        """
+        Update all other node that should have this node in their finger tables,
+        each finger index is independent so the lookups and updates run concurrently
+        """
+        def update_ith_finger(i):
+            # find last node p whose i-th finger might be this node
             p = self.find_predecessor((1 + self.node - 2**(i-1) + NODES) % NODES)
-            self.call_rpc(p, UPDATE_FINGER_TABLE, self.node, i)
+            return self.call_rpc(p, UPDATE_FINGER_TABLE, self.node, i)
+
+        with ThreadPoolExecutor(max_workers=JOIN_WORKERS) as pool:
+            list(pool.map(update_ith_finger, range(1, M+1)))
 
     def update_finger_table(self, s, i):
         """ if s is i-th finger of n, update this node's finger table with s """
         if (self.finger[i].start != self.finger[i].node 
                  and s in ModRange(self.finger[i].start, self.finger[i].node, NODES)):
-            print('update_finger_table({},{}): {}[{}] = {} since {} in [{},{})\n'.format(
-                     s, i, self.node, i, s, s, self.finger[i].start, self.finger[i].node))
+            logger.info('update_finger_table(%s,%s): %s[%s] = %s since %s in [%s,%s)',
+                        s, i, self.node, i, s, s, self.finger[i].start, self.finger[i].node)
             self.finger[i].node = s
             p = self.predecessor  # get first node preceding myself
             self.call_rpc(p, UPDATE_FINGER_TABLE, s, i)
@@ -395,6 +622,7 @@ if __name__ == '__main__':
         print("Please enter valid command i.e python3 chord_node.py NODEID [NODEID]")
         exit(1)
 
+    logging.basicConfig(level=LOG_LEVEL, format='%(message)s')
     n = int(sys.argv[1])
     node = ChordNode(n)
     if len(sys.argv) > 2:
@@ -2,7 +2,9 @@
 Chord Query
 
 This class is run by running the command
-python3 chord_populate.py [NODE_ID] [KEY]
+python3 chord_query.py [NODE_ID] [KEY]
+or, to find every row whose indexed COLUMN (Player Id, Year or Team) equals VALUE,
+python3 chord_query.py [NODE_ID] [COLUMN] [VALUE]
 NODE_ID is ID of the node in Chord
 
 :Authors: Noha Nomier
@@ -16,16 +18,29 @@ TEST_BASE = 43544  # for testing use port numbers on localhost at TEST_BASE+n
 M = 4  # FIXME: Test environment, normally = hashlib.sha1().digest_size * 8
 BUF_SZ = 4096  # socket recv arg
 
+def recv_all(sock):
+    """Reads from @sock until the other end closes it, replies can be larger than BUF_SZ"""
+    chunks = []
+    while True:
+        chunk = sock.recv(BUF_SZ)
+        if not chunk:
+            return b''.join(chunks)
+        chunks.append(chunk)
+
+
 class ChordQuery:
     """
     An Object responsible to retrieve a value for a given key
     from the DHT-Chord system by the help of a start_node
     """
-    def __init__(self, start_node, key):
+    def __init__(self, start_node, key, column=None):
         self.start_node = start_node
         self.node_address = ('localhost', TEST_BASE + start_node)
         self.target = key
-        self.find_data()
+        if column is None:
+            self.find_data()
+        else:
+            self.scatter_query(column)
 
     def find_data(self):
         """
@@ -34,12 +49,30 @@ class ChordQuery:
         """
         hashed = int.from_bytes(self.sha1(self.target), "big") % (2**M)
         print(f"Sending request for key {self.target} to Node {self.start_node} ... ")
+        response = self.call_start_node("find_data", hashed, self.target)
+        print(f"response:\n\n{response} \n\n")
+
+    def scatter_query(self, column):
+        """
+        Asks the start node to gather every row whose @column equals the target
+        from all the nodes in the ring
+        """
+        print(f"Sending query {column} = {self.target} to Node {self.start_node} ... ")
+        response = self.call_start_node("scatter_query", column, self.target)
+        if isinstance(response, list):
+            for row in response:
+                print(row)
+            print(f"\n{len(response)} rows found\n")
+        else:
+            print(f"response:\n\n{response} \n\n")
+
+    def call_start_node(self, method, arg1, arg2):
+        """sends @method with its arguments to the start node and returns its reply"""
         with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as sock:
             try:
                 sock.connect(self.node_address)
-                sock.sendall(pickle.dumps(("find_data", hashed, self.target)))
-                response = pickle.loads(sock.recv(BUF_SZ))
-                print(f"response:\n\n{response} \n\n")
+                sock.sendall(pickle.dumps((method, arg1, arg2)))
+                return pickle.loads(recv_all(sock))
             except Exception as e:
                 print(f"Error receiving value from Node {self.start_node}: {e}")
 
@@ -50,9 +83,12 @@ class ChordQuery:
 if __name__ == '__main__':
     if len(sys.argv) < 3:
         print("Please enter valid command i.e python3 chord_query.py NODEID KEY")
+        print("or python3 chord_query.py NODEID COLUMN VALUE")
         exit(1)
 
     node = int(sys.argv[1])
-    target_key = sys.argv[2]
-    populate = ChordQuery(node, target_key)
-
+    if len(sys.argv) > 3:
+        populate = ChordQuery(node, sys.argv[3], column=sys.argv[2])
+    else:
+        target_key = sys.argv[2]
+        populate = ChordQuery(node, target_key)
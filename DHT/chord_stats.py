@@ -0,0 +1,73 @@
+"""
+Chord Stats
+
+This class is run by running the command
+python3 chord_stats.py [NODE_ID] [--all]
+NODE_ID is ID of the node in Chord, with --all every node in its ring is asked
+
+:Authors: Noha Nomier
+"""
+import pickle
+import socket
+import sys
+
+from chord_query import recv_all
+
+TEST_BASE = 43544  # for testing use port numbers on localhost at TEST_BASE+n
+
+
+class ChordStats:
+    """
+    An Object that asks Chord nodes for their RPC metrics and prints them
+    """
+    def __init__(self, start_node, whole_ring=False):
+        self.start_node = start_node
+        nodes = [start_node]
+        if whole_ring:
+            nodes = self.ring_nodes()
+        for node in nodes:
+            self.pr_stats(self.call_node(node, "stats"))
+
+    def ring_nodes(self):
+        """returns every node in the ring by following successors from the start node"""
+        nodes = [self.start_node]
+        node = self.call_node(self.start_node, "successor")
+        while node is not None and node != self.start_node and node not in nodes:
+            nodes.append(node)
+            node = self.call_node(node, "successor")
+        return nodes
+
+    def call_node(self, node, method):
+        """sends @method to @node and returns its reply"""
+        with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as sock:
+            try:
+                sock.connect(('localhost', TEST_BASE + node))
+                sock.sendall(pickle.dumps((method, None, None)))
+                return pickle.loads(recv_all(sock))
+            except Exception as e:
+                print(f"Error receiving {method} from Node {node}: {e}")
+
+    @staticmethod
+    def pr_stats(stats):
+        """prints the stats returned by one node"""
+        if stats is None:
+            return
+        print("*"*30)
+        print(f"Node {stats['node']}: {stats['keys']} keys, {stats['bytes_stored']} bytes stored")
+        print(f"hashed ids: {stats['hashed_ids']}\n")
+        print(f"{'method':<26}served\tcalled\tlatency (us bucket: count)")
+        for method in sorted(set(stats['served']) | set(stats['called'])):
+            histogram = stats['latency_us'].get(method, {})
+            buckets = ", ".join(f"<={bucket}: {count}" for bucket, count in sorted(histogram.items()))
+            print(f"{method:<26}{stats['served'].get(method, 0)}\t{stats['called'].get(method, 0)}\t{buckets}")
+        hops = ", ".join(f"{hop}: {count}" for hop, count in sorted(stats['hops'].items()))
+        print(f"\nlookup hops (hops: count): {hops}\n")
+
+
+if __name__ == '__main__':
+    if len(sys.argv) < 2:
+        print("Please enter valid command i.e python3 chord_stats.py NODEID [--all]")
+        exit(1)
+
+    node = int(sys.argv[1])
+    stats = ChordStats(node, whole_ring='--all' in sys.argv[2:])
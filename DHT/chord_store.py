@@ -0,0 +1,423 @@
+"""
+Chord Store
+
+Compact storage for the CSV rows a Chord node is responsible for.
+Rows are kept column by column: numeric columns live in typed arrays and
+every other value is interned once and referenced by its id, so a row
+costs a few bytes per column instead of a list of string objects.
+Rows are rebuilt as lists of strings only when they are read.
+Keys are not kept as strings either: a key made of its row's key columns (as
+chord_populate makes them) is checked against them, and the key index is a pair
+of sorted typed arrays searched with bisect.
+ShardedStore splits the rows over several such stores, each behind its own
+lock, so RPC threads writing different keys don't wait on each other.
+
+:Authors: Noha Nomier
+"""
+import threading
+from array import array
+from bisect import bisect_left, bisect_right
+
+INT, FLOAT, STR = 'int', 'float', 'str'
+TYPECODES = {INT: 'q', FLOAT: 'd', STR: 'H'}  # string columns widen to 'I' past 65535 distinct strings
+INDEXED_COLUMNS = {'Player Id': 0, 'Year': 3, 'Team': 4}  # column name -> position in a row
+KEY_COLUMNS = (0, 3)  # positions of the row values a key is made of, Player Id then Year
+SHARDS = 8  # number of independently locked stores in a ShardedStore
+
+
+def column_kind(text):
+    """
+    Picks the narrowest column type that gives @text back unchanged.
+
+    >>> column_kind('1998'), column_kind('39.6'), column_kind('--'), column_kind('07')
+    ('int', 'float', 'str', 'str')
+    """
+    try:
+        if str(int(text)) == text and -2**63 <= int(text) < 2**63:
+            return INT
+    except ValueError:
+        pass
+    try:
+        if repr(float(text)) == text:
+            return FLOAT
+    except ValueError:
+        pass
+    return STR
+
+
+class StringTable(object):
+    """
+    Interns strings so each distinct value is stored once and referenced by id.
+    The strings are kept UTF-8 encoded back to back in one buffer and found by
+    their hash in a sorted array, so one costs its bytes plus 16 instead of a str and a dict entry.
+
+    >>> table = StringTable()
+    >>> table.intern('Chicago Bears'), table.intern('QB'), table.intern('Chicago Bears')
+    (0, 1, 0)
+    >>> table.lookup(1), table.find('QB'), table.find('RB'), len(table)
+    ('QB', 1, None, 2)
+    """
+    def __init__(self):
+        self.text = bytearray()
+        self.offsets = array('I', [0])  # string id -> where it starts in text, the last one is where text ends
+        self.hashes = array('q')  # hash of every string in ascending order
+        self.hash_ids = array('I')  # id of the string each of those hashes belongs to
+
+    def find(self, text):
+        """returns the id of @text, or None if it was never interned"""
+        text_hash = hash(text)
+        at = bisect_left(self.hashes, text_hash)
+        while at < len(self.hashes) and self.hashes[at] == text_hash:
+            if self.lookup(self.hash_ids[at]) == text:
+                return self.hash_ids[at]
+            at += 1  # another string with the same hash
+        return None
+
+    def intern(self, text):
+        """returns the id of @text, adding it to the table the first time it is seen"""
+        string_id = self.find(text)
+        if string_id is None:
+            string_id = len(self)
+            self.text += text.encode()
+            self.offsets.append(len(self.text))
+            at = bisect_right(self.hashes, hash(text))
+            self.hashes.insert(at, hash(text))
+            self.hash_ids.insert(at, string_id)
+        return string_id
+
+    def lookup(self, string_id):
+        """returns the string stored under @string_id"""
+        return self.text[self.offsets[string_id]:self.offsets[string_id + 1]].decode()
+
+    def nbytes(self):
+        """rough number of bytes taken by the distinct strings"""
+        return len(self.text) + sum(values.itemsize * len(values)
+                                    for values in (self.offsets, self.hashes, self.hash_ids))
+
+    def __len__(self):
+        return len(self.offsets) - 1
+
+
+class LockedStringTable(StringTable):
+    """
+    StringTable that several stores can intern into from different threads,
+    every call holds the table's own lock
+    """
+    def __init__(self):
+        super().__init__()
+        self.lock = threading.RLock()  # reentrant as intern calls find
+
+    def find(self, text):
+        with self.lock:
+            return super().find(text)
+
+    def intern(self, text):
+        with self.lock:
+            return super().intern(text)
+
+    def lookup(self, string_id):
+        with self.lock:
+            return super().lookup(string_id)
+
+    def nbytes(self):
+        with self.lock:
+            return super().nbytes()
+
+
+class Column(object):
+    """
+    One column of the store, typed by the first value put in it.
+    Values that don't fit the column type (e.g. '--' in a numeric column)
+    are interned and their id is kept in the same slot, flagged in @interned
+    """
+    def __init__(self, kind, length=0):
+        self.kind = kind
+        self.values = array(TYPECODES[kind], [0]) * length
+        self.interned = array('B', [0]) * length if kind != STR else None
+
+    def set(self, index, text, strings):
+        """overwrites the value of row @index with @text"""
+        if self.kind == STR:
+            string_id = strings.intern(text)
+            if string_id > 0xFFFF and self.values.typecode == 'H':
+                self.values = array('I', self.values)
+            self.values[index] = string_id
+        elif column_kind(text) == self.kind:
+            self.values[index] = int(text) if self.kind == INT else float(text)
+            self.interned[index] = 0
+        else:
+            self.values[index] = strings.intern(text)
+            self.interned[index] = 1
+
+    def append(self, text, strings):
+        """adds @text as a new row value, a None @text leaves an empty placeholder"""
+        self.values.append(0)
+        if self.interned is not None:
+            self.interned.append(0)
+        if text is not None:
+            self.set(len(self.values) - 1, text, strings)
+
+    def get(self, index, strings):
+        """returns the value of row @index as the original string"""
+        value = self.values[index]
+        if self.kind == STR or self.interned[index]:
+            return strings.lookup(int(value))
+        return str(value) if self.kind == INT else repr(value)
+
+    def nbytes(self):
+        """rough number of bytes taken by this column"""
+        nbytes = self.values.itemsize * len(self.values)
+        if self.interned is not None:
+            nbytes += len(self.interned)
+        return nbytes
+
+
+class ColumnarStore(object):
+    """
+    Key/row store used by a ChordNode, rows are grouped by the hashed id they
+    were put under and looked up by their original key.
+
+    >>> store = ColumnarStore()
+    >>> store.put(3, 'tomfarris/25138611947', ['tomfarris/2513861', 'Farris, Tom', '', '1947', '9', '--', '0.0'])
+    >>> store.put(3, 'tomfarris/25138611948', ['tomfarris/2513861', 'Farris, Tom', '', '1948', '0', '2', '39.6'])
+    >>> store.get(3, 'tomfarris/25138611948')
+    ['tomfarris/2513861', 'Farris, Tom', '', '1948', '0', '2', '39.6']
+    >>> store.get(3, 'missing') is None, store.get(4, 'tomfarris/25138611948') is None
+    (True, True)
+    >>> 3 in store, 4 in store, len(store)
+    (True, False, 2)
+    >>> store.query('Year', '1947')
+    [['tomfarris/2513861', 'Farris, Tom', '', '1947', '9', '--', '0.0']]
+    >>> store.put(4, 'any key', ['a', 'b']); store.get(4, 'any key'), store.key_of(2)
+    (['a', 'b'], 'any key')
+    """
+    def __init__(self, indexed_columns=INDEXED_COLUMNS, key_columns=KEY_COLUMNS, strings=None, kinds=None):
+        """
+        :param strings: StringTable shared with other stores, whoever passes it counts its bytes,
+                        by default the store has a table of its own
+        :param kinds: {column position: kind} shared with other stores so they all type a column
+                      alike, by the first value any of them got for it
+        """
+        self.own_strings = strings is None
+        self.strings = StringTable() if strings is None else strings
+        self.kinds = {} if kinds is None else kinds
+        self.columns = []
+        self.widths = array('H')  # number of columns in each row
+        self.key_columns = tuple(key_columns)
+        # the key index: hash((hashed_id, key)) of every row in ascending order, and the row each belongs to
+        self.key_hashes = array('q')
+        self.key_rows = array('I')
+        self.row_keys = array('i')  # row index -> string id of its key, -1 when made of its key columns
+        self.hashed_id_ids = {}  # hashed id -> small id, as hashed ids are few and may not fit an array
+        self.row_hashed_ids = array('I')  # row index -> small id of its hashed id
+        self.indexed_columns = dict(indexed_columns)
+        # column position -> ascending (string id of a value << 32 | index of a row holding it)
+        self.indexes = {position: array('q') for position in self.indexed_columns.values()}
+
+    def put(self, hashed_id, key, row):
+        """stores @row under @hashed_id and @key, replacing any row already there"""
+        index = self.find(hashed_id, key)
+        if index is None:
+            index = len(self.widths)
+            self.widths.append(len(row))
+            self.add_row(index, row)
+            self.add_key(index, hashed_id, key, row)
+        else:
+            self.unindex_row(index)
+            self.widths[index] = len(row)
+            self.set_row(index, row)
+            if self.row_keys[index] < 0 and self.key_of(index) != key:
+                self.row_keys[index] = self.strings.intern(key)  # the new row no longer spells its key
+        self.index_row(index, row)
+
+    def add_key(self, index, hashed_id, key, row):
+        """adds new row @index to the key index under @hashed_id and @key"""
+        spelled = (''.join(row[position] for position in self.key_columns)
+                   if all(position < len(row) for position in self.key_columns) else None)
+        self.row_keys.append(-1 if spelled == key else self.strings.intern(key))
+        self.row_hashed_ids.append(self.hashed_id_ids.setdefault(hashed_id, len(self.hashed_id_ids)))
+        key_hash = hash((hashed_id, key))
+        at = bisect_right(self.key_hashes, key_hash)
+        self.key_hashes.insert(at, key_hash)
+        self.key_rows.insert(at, index)
+
+    def find(self, hashed_id, key):
+        """returns the index of the row stored under @hashed_id and @key, or None"""
+        hashed_id_id = self.hashed_id_ids.get(hashed_id)
+        if hashed_id_id is None:
+            return None
+        key_hash = hash((hashed_id, key))
+        at = bisect_left(self.key_hashes, key_hash)
+        while at < len(self.key_hashes) and self.key_hashes[at] == key_hash:
+            index = self.key_rows[at]
+            if self.row_hashed_ids[index] == hashed_id_id and self.key_of(index) == key:
+                return index
+            at += 1  # another key with the same hash
+        return None
+
+    def key_of(self, index):
+        """returns the key row @index was put under"""
+        if self.row_keys[index] >= 0:
+            return self.strings.lookup(self.row_keys[index])
+        return ''.join(self.columns[position].get(index, self.strings) for position in self.key_columns)
+
+    def index_row(self, index, row):
+        """adds row @index to the secondary index of every indexed column it has"""
+        for position, entries in self.indexes.items():
+            if position < len(row):
+                entry = self.strings.intern(row[position]) << 32 | index
+                entries.insert(bisect_left(entries, entry), entry)
+
+    def unindex_row(self, index):
+        """drops row @index from the secondary indexes before it is overwritten"""
+        for position, entries in self.indexes.items():
+            if position < self.widths[index]:
+                entry = self.strings.intern(self.columns[position].get(index, self.strings)) << 32 | index
+                del entries[bisect_left(entries, entry)]
+
+    def query(self, column, value):
+        """
+        returns the rows whose @column (a name from the indexed columns) equals @value,
+        raises KeyError if @column isn't indexed
+        """
+        entries = self.indexes[self.indexed_columns[column]]
+        value_id = self.strings.find(value)
+        if value_id is None:
+            return []
+        start, end = bisect_left(entries, value_id << 32), bisect_left(entries, (value_id + 1) << 32)
+        return [self.materialize(entries[at] & 0xFFFFFFFF) for at in range(start, end)]
+
+    def add_row(self, index, row):
+        """appends @row as row @index, growing the set of columns if it is wider than the others"""
+        for column_index, column in enumerate(self.columns):
+            column.append(row[column_index] if column_index < len(row) else None, self.strings)
+        for text in row[len(self.columns):]:
+            column = Column(self.kind_of(len(self.columns), text), index)
+            column.append(text, self.strings)
+            self.columns.append(column)
+
+    def kind_of(self, position, text):
+        """returns the kind of the column at @position, set by @text if it is the first value seen there"""
+        return self.kinds.setdefault(position, column_kind(text))  # setdefault is atomic, kinds can be shared
+
+    def set_row(self, index, row):
+        """overwrites row @index with the values in @row"""
+        for column_index, text in enumerate(row):
+            if column_index >= len(self.columns):
+                self.columns.append(Column(self.kind_of(column_index, text), len(self.widths)))
+            self.columns[column_index].set(index, text, self.strings)
+
+    def get(self, hashed_id, key):
+        """returns the row stored under @hashed_id and @key as a list of strings, or None"""
+        index = self.find(hashed_id, key)
+        if index is None:
+            return None
+        return self.materialize(index)
+
+    def materialize(self, index):
+        """rebuilds row @index as the list of strings it was put as"""
+        return [self.columns[column_index].get(index, self.strings)
+                for column_index in range(self.widths[index])]
+
+    def hashed_ids(self):
+        """returns the hashed ids that have at least one row in the store"""
+        return list(self.hashed_id_ids)
+
+    def nbytes(self):
+        """rough number of bytes taken by the stored values and the indexes, a shared string table excluded"""
+        index_arrays = (self.widths, self.key_hashes, self.key_rows, self.row_keys, self.row_hashed_ids,
+                        *self.indexes.values())
+        return ((self.strings.nbytes() if self.own_strings else 0)
+                + sum(values.itemsize * len(values) for values in index_arrays)
+                + sum(column.nbytes() for column in self.columns))
+
+    def __contains__(self, hashed_id):
+        return hashed_id in self.hashed_id_ids
+
+    def __len__(self):
+        return len(self.widths)
+
+
+class ShardedStore(object):
+    """
+    Thread-safe store made of SHARDS ColumnarStores, a row lives in the shard
+    picked by hashing its original key and each shard has its own lock.
+    The shards intern their strings into one LockedStringTable, so a value
+    repeated across shards (a team, '--') is only stored once, and type their
+    columns alike, as a single ColumnarStore would.
+
+    >>> store = ShardedStore(4)
+    >>> store.put_many(3, {'a1999': ['a', 'A', 'QB', '1999'], 'b1999': ['b', 'B', 'QB', '1999']})
+    >>> store.get(3, 'b1999'), len(store), 3 in store
+    (['b', 'B', 'QB', '1999'], 2, True)
+    >>> store.query('Year', '1999')
+    [['a', 'A', 'QB', '1999'], ['b', 'B', 'QB', '1999']]
+    """
+    def __init__(self, shards=SHARDS, indexed_columns=INDEXED_COLUMNS):
+        self.strings = LockedStringTable()
+        kinds = {}
+        self.shards = [ColumnarStore(indexed_columns, strings=self.strings, kinds=kinds) for _ in range(shards)]
+        self.locks = [threading.Lock() for _ in range(shards)]
+
+    def shard_of(self, key):
+        """returns the position of the shard holding @key"""
+        return hash(key) % len(self.shards)
+
+    def put(self, hashed_id, key, row):
+        """stores @row under @hashed_id and @key"""
+        self.put_many(hashed_id, {key: row})
+
+    def put_many(self, hashed_id, entries):
+        """
+        stores every {key: row} in @entries under @hashed_id atomically, all the shards
+        involved are locked (always in the same order) before any row is written
+        """
+        by_shard = {}
+        for key, row in entries.items():
+            by_shard.setdefault(self.shard_of(key), []).append((key, row))
+        involved = sorted(by_shard)
+        for position in involved:
+            self.locks[position].acquire()
+        try:
+            for position in involved:
+                for key, row in by_shard[position]:
+                    self.shards[position].put(hashed_id, key, row)
+        finally:
+            for position in reversed(involved):
+                self.locks[position].release()
+
+    def get(self, hashed_id, key):
+        """returns the row stored under @hashed_id and @key, or None"""
+        position = self.shard_of(key)
+        with self.locks[position]:
+            return self.shards[position].get(hashed_id, key)
+
+    def query(self, column, value):
+        """returns the rows of every shard whose @column equals @value"""
+        rows = []
+        for shard, lock in zip(self.shards, self.locks):
+            with lock:
+                rows.extend(shard.query(column, value))
+        return sorted(rows)
+
+    def hashed_ids(self):
+        """returns the hashed ids that have at least one row in any shard"""
+        hashed_ids = set()
+        for shard, lock in zip(self.shards, self.locks):
+            with lock:
+                hashed_ids.update(shard.hashed_ids())
+        return sorted(hashed_ids)
+
+    def nbytes(self):
+        """rough number of bytes taken by the stored values of all shards"""
+        total = self.strings.nbytes()
+        for shard, lock in zip(self.shards, self.locks):
+            with lock:
+                total += shard.nbytes()
+        return total
+
+    def __contains__(self, hashed_id):
+        return any(hashed_id in shard for shard in self.shards)
+
+    def __len__(self):
+        return sum(len(shard) for shard in self.shards)
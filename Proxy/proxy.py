@@ -4,7 +4,11 @@ Computer Networks, A Simple HTTP Web Proxy
 """
 from socket import *
 from urllib.parse import urlparse
-import sys
+from concurrent.futures import ThreadPoolExecutor
+from collections import OrderedDict
+import argparse
+import os
+import threading
 from pathlib import Path
 
 BUFF_SIZE = 2048
@@ -13,14 +17,176 @@ HTTP_VERSION = 'HTTP/1.1'
 COLON_SEPARATOR = ':'
 LOCAL_HOST_IP = "127.0.0.1"
 CACHE_PATH = "./cache/"
+INDEX_FILE_NAME = 'index'  # cache file of a URL whose path ends in '/', as the path itself names a directory
 CACHE_HIT_STR = 'Cache-Hit: 1' + NEW_LINE_SEPARATOR
 CACHE_MISS_STR = 'Cache-Hit: 0' + NEW_LINE_SEPARATOR
 INTERNAL_ERROR_RESPONSE = 'HTTP/1.1 500 Internal Error'
+WORKERS = 32  # clients served at the same time
+MAX_CONNECTIONS = 128  # clients accepted at a time, the ones beyond WORKERS wait for a free worker
+LISTEN_BACKLOG = 128  # connections the OS queues while MAX_CONNECTIONS are accepted
+CLIENT_TIMEOUT = 10.0  # seconds a client may stay silent before it is dropped
+UPSTREAM_TIMEOUT = 10.0  # seconds to connect to a server, then between bytes of its response
+RELAY_CHUNK = 64 * 1024  # bytes of a response received from the server and relayed at a time
+MAX_HEAD_SIZE = 64 * 1024  # bytes of a response buffered looking for the end of its headers
+HEAD_END = b'\r\n\r\n'
+MEMORY_CACHE_BYTES = 64 * 1024 * 1024  # cached responses kept in memory, least recently used go first
+MEMORY_OBJECT_BYTES = 256 * 1024  # larger cached responses stay on disk and are sent with sendfile
+DISK_CACHE_BYTES = 1024 * 1024 * 1024  # cached responses kept in CACHE_PATH, least recently used go first
+MEGABYTE = 1024 * 1024
+
+
+class ProxyCache():
+    def __init__(self, path=CACHE_PATH, memory_bytes=MEMORY_CACHE_BYTES, disk_bytes=DISK_CACHE_BYTES,
+                 memory_object_bytes=MEMORY_OBJECT_BYTES):
+        """
+        Constructs a two-tier cache of responses: files under @path holding at most
+        @disk_bytes, and the most recently used of them no larger than
+        @memory_object_bytes in memory up to @memory_bytes.
+        Each tier evicts its least recently used entries. Entries are keyed by their
+        file path, files already under @path count as used in modification time order.
+        It is shared by the proxy threads, every index change happens under one lock
+        """
+        self.path = path
+        self.memory_bytes = memory_bytes
+        self.memory_object_bytes = min(memory_object_bytes, memory_bytes)
+        self.disk_bytes = disk_bytes
+        self.lock = threading.Lock()
+        self.memory = OrderedDict()  # file path -> response, least recently used first
+        self.memory_size = 0
+        self.disk = OrderedDict()  # file path -> size, least recently used first
+        self.disk_size = 0
+        self.load_index()
+
+    def load_index(self):
+        """
+        Indexes the files already in the cache directory, evicting the oldest ones
+        if they don't fit the disk budget
+        """
+        entries = []
+        for directory, _, files in os.walk(self.path):
+            for name in files:
+                file_path = os.path.join(directory, name)
+                try:
+                    if name.startswith('.') and name.endswith('.tmp'):  # left by an interrupted write
+                        os.remove(file_path)
+                        continue
+                    stat = os.stat(file_path)
+                except OSError:
+                    continue
+                entries.append((stat.st_mtime, file_path, stat.st_size))
+        with self.lock:
+            for _, file_path, size in sorted(entries):
+                self.disk[file_path] = size
+                self.disk_size += size
+            self.evict_disk()
+
+    def get(self, file_path):
+        """
+        Returns the cached response for @file_path or None. A response kept in memory
+        is returned as bytes, a small one only found on disk is read into memory,
+        larger ones are returned as a binary file open at their start, which the
+        caller closes. An open file stays readable if the entry is evicted meanwhile
+        """
+        with self.lock:
+            content = self.memory.get(file_path)
+            if content is not None:
+                self.memory.move_to_end(file_path)
+                self.disk.move_to_end(file_path)
+                return content
+            size = self.disk.get(file_path)
+            if size is None:
+                return None
+            self.disk.move_to_end(file_path)
+        try:
+            cached_file = open(file_path, 'rb')
+        except OSError:  # evicted by another thread meanwhile
+            return None
+        if size > self.memory_object_bytes:
+            return cached_file
+        with cached_file:
+            content = cached_file.read()
+        with self.lock:
+            if file_path in self.disk:
+                self.remember(file_path, content)
+        return content
+
+    def create(self, file_path):
+        """
+        Opens a temporary file next to @file_path to write its response into, for
+        commit to rename into place once it is complete, so readers never see part
+        of it. Returns None if the file can't be created
+        """
+        path = Path(file_path)
+        temp_path = path.with_name(f'.{path.name}.{threading.get_ident()}.tmp')
+        try:
+            path.parent.mkdir(parents=True, exist_ok=True)
+            return temp_path.open('wb')
+        except OSError as e:
+            print(f'Failed to cache {file_path}: {e}')
+            return None
+
+    def commit(self, file_path, temp_file):
+        """caches the response written to @temp_file (from create) for @file_path"""
+        try:
+            temp_file.close()
+            size = os.path.getsize(temp_file.name)
+            os.replace(temp_file.name, file_path)
+        except OSError as e:
+            print(f'Failed to cache {file_path}: {e}')
+            self.discard(temp_file)
+            return
+        with self.lock:
+            self.disk_size += size - self.disk.pop(file_path, 0)
+            self.disk[file_path] = size
+            self.memory_size -= len(self.memory.pop(file_path, b''))  # the next get reads the new one
+            self.evict_disk()
+
+    def discard(self, temp_file):
+        """drops the incomplete response written to @temp_file (from create)"""
+        temp_file.close()
+        try:
+            os.remove(temp_file.name)
+        except OSError:
+            pass
+
+    def remember(self, file_path, content):
+        """keeps @content in memory, called with the lock held"""
+        self.memory_size -= len(self.memory.pop(file_path, b''))
+        if len(content) > self.memory_object_bytes:
+            return
+        self.memory[file_path] = content
+        self.memory_size += len(content)
+        while self.memory_size > self.memory_bytes:
+            _, evicted = self.memory.popitem(last=False)
+            self.memory_size -= len(evicted)
+
+    def evict_disk(self):
+        """removes the least recently used files until the disk budget is met, called with the lock held"""
+        while self.disk_size > self.disk_bytes:
+            file_path, size = self.disk.popitem(last=False)
+            self.disk_size -= size
+            self.memory_size -= len(self.memory.pop(file_path, b''))
+            try:
+                os.remove(file_path)
+            except OSError as e:
+                print(f'Failed to evict {file_path}: {e}')
 
 class HttpProxy():
-    def __init__(self, port):
-        """ Constructs an HTTP Proxy that listens on the given port """
+    def __init__(self, port, workers=WORKERS, max_connections=MAX_CONNECTIONS,
+                 client_timeout=CLIENT_TIMEOUT, upstream_timeout=UPSTREAM_TIMEOUT, cache=None):
+        """
+        Constructs an HTTP Proxy that listens on the given port and serves up to @workers
+        clients at once on a thread pool, accepting at most @max_connections before
+        leaving the rest in the listen backlog. @client_timeout and @upstream_timeout
+        are socket timeouts in seconds (None to wait forever). Responses are cached in
+        @cache, a ProxyCache with the default budgets if not given
+        """
+        self.cache = ProxyCache() if cache is None else cache
         self.proxy_port = port
+        self.workers = workers
+        self.connections = threading.BoundedSemaphore(max(workers, max_connections))
+        self.client_timeout = client_timeout
+        self.upstream_timeout = upstream_timeout
 
     def entry_point(self):
         """ Proxy starting Point"""
@@ -32,33 +198,53 @@ class HttpProxy():
         connections from clients
         """
         print(f"Starting HTTP proxy on port: {self.proxy_port}")
-        with socket(AF_INET, SOCK_STREAM) as proxy:
+        with socket(AF_INET, SOCK_STREAM) as proxy, ThreadPoolExecutor(self.workers) as pool:
+            proxy.setsockopt(SOL_SOCKET, SO_REUSEADDR, 1)
             proxy.bind((LOCAL_HOST_IP, int(self.proxy_port)))
-            proxy.listen()
-            self.get_connection(proxy)
+            proxy.listen(LISTEN_BACKLOG)
+            self.get_connection(proxy, pool)
 
-    def get_connection(self, proxy):
+    def get_connection(self, proxy, pool):
         """
-        Keeps listening for client connections,
-        receives client request and return back appropriate response
+        Keeps listening for client connections and hands each one to a worker of @pool,
+        waiting for a connection to finish first when MAX_CONNECTIONS are being served
         """
         while True:
+            self.connections.acquire()
             print("*" * 25 + " Ready to serve... " + "*" * 25 + "\n")
-            conn, client_addr = proxy.accept()
+            try:
+                conn, client_addr = proxy.accept()
+            except BaseException:
+                self.connections.release()
+                raise
             print(f"Connecting to client with address: {client_addr}")
-            request_buffer = self.receive_data(conn)
-            response = b''
-            if (self.is_http_request_invalid(request_buffer) == True):
-                print(f'Request sent from client is invalid ...')
-                response = bytes(
-                    'Invalid Request, Please Try Again \n', 'UTF-8')
-            else:
-                response = self.handle_http_request(request_buffer)
+            pool.submit(self.serve_client, conn, client_addr)
 
-            print("Now sending response back to client..")
-            conn.sendall(response)
-            print("All Done! Closing connection...")
+    def serve_client(self, conn, client_addr):
+        """
+        Receives the request of the client connected on @conn and sends back the
+        appropriate response, then closes the connection
+        """
+        try:
+            conn.settimeout(self.client_timeout)  # set once a worker picks the connection up, not while queued
+            self.handle_client(conn)
+        except Exception as e:  # timeouts included, a worker must always give its connection back
+            print(f"Connection with client {client_addr} failed: {type(e).__name__}: {e}")
+        finally:
             conn.close()
+            self.connections.release()
+
+    def handle_client(self, conn):
+        """
+        Receives client request and return back appropriate response
+        """
+        request_buffer = self.receive_data(conn)
+        if (self.is_http_request_invalid(request_buffer) == True):
+            print(f'Request sent from client is invalid ...')
+            conn.sendall(bytes('Invalid Request, Please Try Again \n', 'UTF-8'))
+        else:
+            self.handle_http_request(request_buffer, conn)
+        print("All Done! Closing connection...")
 
     def is_http_request_invalid(self, http_raw_data):
         """
@@ -87,13 +273,13 @@ class HttpProxy():
             NEW_LINE_SEPARATOR + NEW_LINE_SEPARATOR
         return self.to_bytes(message)
 
-    def handle_http_request(self, http_raw_data):
+    def handle_http_request(self, http_raw_data, conn):
         """
         Takes client request @http_raw_data and parses it by retrieving:
         host_name, host_port, relative_path from the url.
-        Checks if the requested url is cached, then it returns it immediately,
-        otherwise, sends a request to the requested server to retrieve 
-        the desired response and returns it
+        Checks if the requested url is cached, then it sends it immediately to the
+        client on @conn, otherwise, sends a request to the requested server and
+        relays the desired response
         """
         data_lines = http_raw_data.split(NEW_LINE_SEPARATOR)
         first_line = data_lines[0].strip().split()
@@ -110,11 +296,19 @@ class HttpProxy():
         # Check for cache in here, We assume that url with different ports are always different requests
         cache_entry_path = CACHE_PATH + host_name + \
             f'/{str(host_port)}' + relative_path
+        if not relative_path or relative_path.endswith('/'):
+            cache_entry_path = cache_entry_path.rstrip('/') + '/' + INDEX_FILE_NAME
 
-        if Path(cache_entry_path).exists():
+        file_data = self.cache.get(cache_entry_path)
+        if isinstance(file_data, bytes):
             print("Requested data is found in cache and will be sent to client!")
-            file_data = self.read_file(cache_entry_path)
-            return file_data
+            conn.sendall(file_data)
+            return
+        if file_data is not None:
+            print("Requested data is found in cache and will be sent to client from disk!")
+            with file_data:
+                conn.sendfile(file_data)
+            return
 
         print(f"No cache hit, sending request to the server {(host_name, host_port)}")
 
@@ -125,49 +319,58 @@ class HttpProxy():
         http_request_to_server = self.construct_http_request(
             method, relative_path, headers)
 
-        return self.get_response_from_server(host_name, host_port, http_request_to_server, cache_entry_path)
+        self.get_response_from_server(host_name, host_port, http_request_to_server, cache_entry_path, conn)
 
-    def get_response_from_server(self, host_name, host_port, http_request_to_server, cache_entry_path):
+    def get_response_from_server(self, host_name, host_port, http_request_to_server, cache_entry_path, conn):
         """
-        Sends @http_request_to_server with address (@host_name, @host_port),
-        Caches the response in a file in @cache_entry_path and returns it or
-        in the case of an error returns a failure response instead
+        Sends @http_request_to_server with address (@host_name, @host_port) and relays
+        the response to the client on @conn as it arrives, or in the case of an error
+        sends a failure response instead. A 200 response is written to the cache for
+        @cache_entry_path at the same time, and only kept if it arrives in full
         """
         print(f"Request message being sent to server: {http_request_to_server}")
 
-        received_data = ''
-
         with socket(AF_INET, SOCK_STREAM) as s_from_proxy_to_server:
+            s_from_proxy_to_server.settimeout(self.upstream_timeout)
             try:
                 s_from_proxy_to_server.connect((host_name, host_port))
                 s_from_proxy_to_server.sendall(http_request_to_server)
             except Exception as e:
                 print(f'Failed to connect to {(host_name, host_port)}: {e}')
-                return b'Failed to connect to server host \n\r'
+                conn.sendall(b'Failed to connect to server host \n\r')
+                return
+
+            head, body = self.receive_server_head(s_from_proxy_to_server)
+            head_lines = head.split(b'\r\n')
+            first_response_line = head_lines[0]
+            headers = b'\r\n'.join(head_lines[1:])
+            status_line = first_response_line.split()
+            status_code = status_line[1] if len(status_line) > 1 else b''
+
+            cache_file = None
+            if status_code == b'404':
+                print(f"Status code is 404, No Cache Writing")
+                conn.sendall(first_response_line + self.to_bytes(NEW_LINE_SEPARATOR + CACHE_MISS_STR + NEW_LINE_SEPARATOR))
+            elif status_code != b'200':
+                print(f"Status code is not 200 or 404, No Cache Writing")
+                conn.sendall(self.to_bytes(INTERNAL_ERROR_RESPONSE + NEW_LINE_SEPARATOR + CACHE_MISS_STR + NEW_LINE_SEPARATOR))
             else:
-                received_data = self.receive_server_response(s_from_proxy_to_server)
-                decoded_received_data = received_data.decode('UTF-8')
-                received_data_lines = decoded_received_data.split(NEW_LINE_SEPARATOR)
-
-                first_response_line = received_data_lines[0]
-                remaining_server_response = NEW_LINE_SEPARATOR.join(received_data_lines[1:])
-                content_lines = NEW_LINE_SEPARATOR + NEW_LINE_SEPARATOR.join(decoded_received_data.split(NEW_LINE_SEPARATOR + NEW_LINE_SEPARATOR)[1:])
-                status_code = first_response_line.split()[1]
-
-                if status_code == '404':
-                    print(f"Status code is {status_code}, No Cache Writing")
-                    return self.to_bytes(received_data_lines[0] + NEW_LINE_SEPARATOR + CACHE_MISS_STR + content_lines + NEW_LINE_SEPARATOR)
-                elif status_code != '200':
-                    print(f"Status code is not 200 or 404, No Cache Writing")
-                    return self.to_bytes(INTERNAL_ERROR_RESPONSE + NEW_LINE_SEPARATOR + CACHE_MISS_STR + content_lines + NEW_LINE_SEPARATOR)
-
                 print(f"Status code 200, Now writing to file...")
-                content_of_file = received_data_lines[0] + NEW_LINE_SEPARATOR + \
-                    CACHE_HIT_STR + content_lines + NEW_LINE_SEPARATOR
-                self.write_to_file(content_of_file, cache_entry_path)
-                s_from_proxy_to_server.close()
-            
-            return self.to_bytes(received_data_lines[0] + NEW_LINE_SEPARATOR + CACHE_MISS_STR + remaining_server_response + NEW_LINE_SEPARATOR)
+                conn.sendall(first_response_line + self.to_bytes(NEW_LINE_SEPARATOR + CACHE_MISS_STR) +
+                             (headers + b'\r\n' if headers else b'') + b'\r\n')
+                cache_file = self.cache.create(cache_entry_path)
+                if cache_file is not None:
+                    cache_file.write(first_response_line + self.to_bytes(NEW_LINE_SEPARATOR + CACHE_HIT_STR + NEW_LINE_SEPARATOR))
+
+            complete = False
+            try:
+                complete = self.relay_server_response(s_from_proxy_to_server, body, conn, cache_file)
+            finally:
+                if cache_file is not None:
+                    if complete:
+                        self.cache.commit(cache_entry_path, cache_file)
+                    else:
+                        self.cache.discard(cache_file)
 
     @staticmethod
     def to_bytes(text):
@@ -176,20 +379,48 @@ class HttpProxy():
         """
         return bytes(text, 'UTF-8')
 
-    def receive_server_response(self, s_from_proxy_to_server):
+    def receive_server_head(self, s_from_proxy_to_server):
         """
-        Handles content received from server and returns it
+        Receives the server response up to the blank line ending its headers (or
+        MAX_HEAD_SIZE bytes), returns the head without that blank line and the part
+        of the body that came with it
         """
-        data = b''
-        while True:
+        data = bytearray()
+        while len(data) < MAX_HEAD_SIZE:
             try:
-                data_from_server_to_proxy = s_from_proxy_to_server.recv(BUFF_SIZE)
-            except Exception as e:
-                print(f'e {e}')
-            if len(data_from_server_to_proxy) <= 0:
+                data_from_server_to_proxy = s_from_proxy_to_server.recv(RELAY_CHUNK)
+            except OSError as e:
+                print(f'Failed to receive from server: {e}')
                 break
+            if not data_from_server_to_proxy:
+                break
+            searched = max(0, len(data) - len(HEAD_END) + 1)
             data += data_from_server_to_proxy
-        return data
+            end = data.find(HEAD_END, searched)
+            if end >= 0:
+                return bytes(data[:end]), bytes(data[end + len(HEAD_END):])
+        return bytes(data), b''
+
+    def relay_server_response(self, s_from_proxy_to_server, body, conn, cache_file):
+        """
+        Sends the @body received so far and the rest of the server response to the
+        client on @conn chunk by chunk, writing them to @cache_file too if not None.
+        Returns whether the response arrived in full, a server silent for longer than
+        the upstream timeout ends it early
+        """
+        data_from_server_to_proxy = body
+        while True:
+            if data_from_server_to_proxy:
+                conn.sendall(data_from_server_to_proxy)
+                if cache_file is not None:
+                    cache_file.write(data_from_server_to_proxy)
+            try:
+                data_from_server_to_proxy = s_from_proxy_to_server.recv(RELAY_CHUNK)
+            except OSError as e:
+                print(f'Failed to receive from server: {e}')
+                return False
+            if not data_from_server_to_proxy:
+                return True
 
     def receive_data(self, conn):
         """
@@ -203,35 +434,35 @@ class HttpProxy():
             data = data.decode('UTF-8')
             request_buffer += data
             last_received = data
-            if not data:
+            if not data or request_buffer.endswith(NEW_LINE_SEPARATOR * 2):
                 break
 
         print(f"Received a message from client: {request_buffer}")
         return request_buffer
 
-    def write_to_file(self, content, file_path):
-        """
-        Writes @content to the @file_path given using pathlib
-        """
-        path = Path(file_path)
-        path.parent.mkdir(parents=True, exist_ok=True)
-        with path.open("w", encoding="utf-8") as f:
-            f.write(content)
-
-    def read_file(self, full_path):
-        """
-        Reads file contents of file at @full_path, this is only called if the file exists
-        """
-        return Path(full_path).read_bytes()
-
 
 def main():
-    if len(sys.argv) != 2:
-        print("Please enter valid command i.e python3 proxy.py PROXY_PORT")
-        exit(1)
-
-    proxy_port = int(sys.argv[1])
-    proxy = HttpProxy(proxy_port)
+    parser = argparse.ArgumentParser(description='A simple caching HTTP web proxy')
+    parser.add_argument('port', type=int, help='port the proxy listens on')
+    parser.add_argument('--workers', type=int, default=WORKERS, help='clients served at the same time')
+    parser.add_argument('--max-connections', type=int, default=MAX_CONNECTIONS,
+                        help='clients accepted at a time, waiting ones stay in the listen backlog')
+    parser.add_argument('--client-timeout', type=float, default=CLIENT_TIMEOUT,
+                        help='seconds a client may stay silent before it is dropped')
+    parser.add_argument('--upstream-timeout', type=float, default=UPSTREAM_TIMEOUT,
+                        help='seconds to wait on the server when connecting and receiving')
+    parser.add_argument('--memory-cache', type=float, default=MEMORY_CACHE_BYTES / MEGABYTE,
+                        help='megabytes of cached responses kept in memory')
+    parser.add_argument('--memory-object', type=float, default=MEMORY_OBJECT_BYTES / MEGABYTE,
+                        help='megabytes a cached response may have to be kept in memory, larger ones are sent from disk')
+    parser.add_argument('--disk-cache', type=float, default=DISK_CACHE_BYTES / MEGABYTE,
+                        help=f'megabytes of cached responses kept in {CACHE_PATH}')
+    args = parser.parse_args()
+
+    cache = ProxyCache(CACHE_PATH, int(args.memory_cache * MEGABYTE), int(args.disk_cache * MEGABYTE),
+                       int(args.memory_object * MEGABYTE))
+    proxy = HttpProxy(args.port, args.workers, args.max_connections, args.client_timeout, args.upstream_timeout,
+                      cache)
     proxy.entry_point()
 
 
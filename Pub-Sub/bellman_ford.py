@@ -2,89 +2,606 @@
 Bellman Ford
 :Authors: Noha Nomier
 """
+import heapq
 import math
+from array import array
+from collections import deque
+from itertools import count
+
+try:
+    import numpy as np
+except ImportError:  # numpy is only needed by MatrixBellmanFord
+    np = None
+
+INF = float('inf')
+PRUNE_SLACK = 1e-12  # a path is kept if its bound is this close to the threshold, for rounding between the sums
+
+def profitable_cycles(graph, max_length=4, fee=0.0, min_profit=0.0, starts=None, limit=None):
+    """
+    Enumerates every simple cycle of 3 to @max_length currencies in @graph (a dictionary
+    like BellmanFord.graph) that still makes more than @min_profit after paying @fee
+    on each exchange. Profit is the fraction gained going once around the cycle.
+    Each cycle is reported once, starting from its smallest currency, and the list is
+    sorted best first as (profit, [curr, ..., curr]) pairs.
+    With @starts only the cycles whose smallest currency is in @starts are enumerated,
+    so disjoint @starts split the work without finding a cycle twice.
+    With @limit only the @limit best cycles are kept, in a heap, and once it is full a
+    cycle must beat the worst of them instead of just the threshold.
+    A path is only extended while its weight plus the cheapest way back to its start
+    (see distances_back) can still come under the threshold, so in a market that is
+    mostly consistent only the paths around a mispriced cross are explored.
+
+    >>> bf = BellmanFord()
+    >>> bf.add_edge('USD', 'GBP', 0.8); bf.add_edge('GBP', 'EUR', 1.25); bf.add_edge('EUR', 'USD', 1.2)
+    >>> [(round(profit, 4), cycle) for profit, cycle in profitable_cycles(bf.get_graph())]
+    [(0.2, ['EUR', 'USD', 'GBP', 'EUR'])]
+    >>> profitable_cycles(bf.get_graph(), fee=0.1)
+    []
+
+    Pruning: six currencies priced consistently but for a 1% mispriced AUD/CAD cross.
+    Only the paths that can still close into a cycle through that cross are extended,
+    23 where an exhaustive search extends all 151
+
+    >>> market = BellmanFord()
+    >>> usd_per = {'AUD': 0.65, 'CAD': 0.73, 'CHF': 1.1, 'EUR': 1.08, 'GBP': 1.27, 'JPY': 0.0067}
+    >>> for curr1 in usd_per:
+    ...     for curr2 in usd_per:
+    ...         if curr1 < curr2:
+    ...             mispricing = 1.01 if (curr1, curr2) == ('AUD', 'CAD') else 1
+    ...             market.add_edge(curr1, curr2, usd_per[curr1] / usd_per[curr2] * mispricing)
+    >>> extended = []
+    >>> class Watched(dict):
+    ...     def __getitem__(self, curr):
+    ...         extended.append(curr)
+    ...         return dict.__getitem__(self, curr)
+    >>> cycles = profitable_cycles(Watched(market.get_graph()), min_profit=0.001)
+    >>> len(cycles), cycles[0][1], len(extended)
+    (16, ['AUD', 'CAD', 'GBP', 'CHF', 'AUD'], 23)
+
+    Without a profit floor every cycle rounding makes profitable qualifies. Asking for
+    the best one only holds the pruning to the best cycle found so far instead
+
+    >>> extended.clear()
+    >>> len(profitable_cycles(Watched(market.get_graph()))), len(extended)
+    (52, 139)
+    >>> extended.clear()
+    >>> profitable_cycles(Watched(market.get_graph()), limit=1) == cycles[:1], len(extended)
+    (True, 23)
+    """
+    if not 0 <= fee < 1:
+        raise ValueError('fee must be a fraction in [0, 1)')
+    if limit is not None and limit < 1:
+        raise ValueError('limit must be at least 1')
+    fee_cost = -1 * math.log(1 - fee)  # what a fee adds to a -log(price) edge weight
+    threshold = -1 * math.log(1 + min_profit)  # a cycle must weigh less than this to qualify
+    bound = threshold + PRUNE_SLACK
+
+    order = {curr: i for i, curr in enumerate(sorted(graph))}
+    incoming = {}  # curr -> [(curr it is reached from, weight with the fee)]
+    for u, edges in graph.items():
+        for v, weight in edges.items():
+            incoming.setdefault(v, []).append((u, weight + fee_cost))
+    cycles = []  # (weight, found order, cycle), a heap with the worst on top when there is a @limit
+    found_order = count()
+
+    def found(total, cycle):
+        nonlocal threshold, bound
+        if limit is None:
+            cycles.append((total, next(found_order), cycle))
+            return
+        if len(cycles) < limit:
+            heapq.heappush(cycles, (-1 * total, next(found_order), cycle))
+        else:
+            heapq.heapreplace(cycles, (-1 * total, next(found_order), cycle))
+        if len(cycles) == limit:
+            threshold = -1 * cycles[0][0]  # only a cycle better than the worst kept is worth finding now
+            bound = threshold + PRUNE_SLACK
+
+    def extend(path, weight, back):
+        u = path[-1]
+        left = max_length - len(path)  # edges we may still take after the next one
+        for v, edge_weight in graph[u].items():
+            total = weight + edge_weight + fee_cost
+            if v == path[0]:
+                if len(path) >= 3 and total < threshold:
+                    found(total, path + [v])
+            elif left > 0 and order[v] > order[path[0]] and v not in path:
+                # prune when even the cheapest way back can't bring the cycle under threshold
+                if total + back[left].get(v, INF) < bound:
+                    extend(path + [v], total, back)
+
+    for start in sorted(graph if starts is None else set(starts) & set(graph)):
+        first = order[start]
+        back = distances_back(incoming, start, lambda curr: order[curr] > first, max_length - 1)
+        extend([start], 0, back)
+    if limit is not None:
+        cycles = [(-1 * weight, order, cycle) for weight, order, cycle in cycles]
+    return [(math.exp(-1 * weight) - 1, cycle) for weight, _, cycle in sorted(cycles)]
+
+
+def distances_back(incoming, start, eligible, max_edges):
+    """
+    Returns a list whose k-th item maps each currency to the weight of the cheapest walk
+    of at most k edges from it back to @start, going only through currencies for which
+    @eligible is true, for k up to @max_edges. @incoming maps a currency to the
+    (currency, weight) pairs of its incoming edges. Walks may repeat currencies, so these
+    are lower bounds on what the simple paths back weigh
+
+    >>> incoming = {'USD': [('GBP', 1.0), ('EUR', 5.0)], 'GBP': [('EUR', 1.0)]}
+    >>> distances_back(incoming, 'USD', lambda curr: True, 2)
+    [{'USD': 0}, {'USD': 0, 'GBP': 1.0, 'EUR': 5.0}, {'USD': 0, 'GBP': 1.0, 'EUR': 2.0}]
+    """
+    back = [{start: 0}]
+    for _ in range(max_edges):
+        previous = back[-1]
+        current = dict(previous)
+        for w, distance in previous.items():
+            for v, weight in incoming.get(w, ()):
+                if eligible(v) and weight + distance < current.get(v, INF):
+                    current[v] = weight + distance
+        back.append(current)
+    return back
+
+
+def matrix_graph(weights, names):
+    """
+    Builds a dictionary like BellmanFord.graph from a weight matrix (inf where there is
+    no edge) whose first len(@names) rows and columns belong to @names
+    """
+    n = len(names)
+    graph = {}
+    for i, j in zip(*np.nonzero(np.isfinite(weights[:n, :n]))):
+        graph.setdefault(names[i], {})[names[j]] = float(weights[i, j])
+    return graph
+
 
 class BellmanFord:
     """
     Constructs a BellmanFord object that maintains a graph and runs 
-    bellman ford algorithm on it to tetect negative cycle
+    bellman ford algorithm on it to tetect negative cycle.
+    Currencies are interned to integer vertex ids and the edges kept in flat arrays,
+    one slot per edge holding its source, target and -log(price) weight, so a price
+    update only overwrites a float. For relaxing, the out-edges of every vertex are
+    laid out contiguously (CSR: the slots of vertex u's edges are
+    adjacency[offsets[u]:offsets[u + 1]]), rebuilt only when edges come or go.
+
+    >>> bf = BellmanFord()
+    >>> bf.add_edge('USD', 'GBP', 0.8); bf.add_edge('GBP', 'EUR', 1.25); bf.add_edge('EUR', 'USD', 1.2)
+    >>> bf.get_nodes(), round(bf.get_graph()['USD']['GBP'], 4)
+    (['USD', 'GBP', 'EUR'], 0.2231)
+    >>> bf.shortest_paths('USD', 1e-9)[2] is not None
+    True
     """
+    __slots__ = ('ids', 'names', 'edge_slots', 'sources', 'targets', 'weights', 'free', 'degree',
+                 'offsets', 'adjacency', 'layout_stale', 'view', 'path_distances', 'path_predecessor')
+
     def __init__(self):
-        self.graph = {} #graph would look like {c1: {c2:price, c3,price} , c2: {c1,price, c4,price}, ....}
+        self.ids = {}  # currency -> vertex id, ids are never reused
+        self.names = []  # vertex id -> currency
+        self.edge_slots = {}  # (curr1, curr2) -> slot of the edge curr1 -> curr2
+        self.sources = array('i')  # slot -> u id, -1 for a removed edge
+        self.targets = array('i')  # slot -> v id
+        self.weights = array('d')  # slot -> -log(price)
+        self.free = []  # first slots of removed pairs of edges, reused by new ones
+        self.degree = array('i')  # vertex id -> number of out-edges, a vertex without any isn't in the graph
+        self.offsets = array('i')
+        self.adjacency = array('i')
+        self.layout_stale = False  # edges came or went since offsets and adjacency were built
+        self.view = None  # dictionary returned by get_graph, until the next change
+        self.path_distances = []  # buffers reused by every shortest_paths call
+        self.path_predecessor = []
+
+    def vertex(self, curr):
+        """returns the id of @curr, interning it the first time it is seen"""
+        vertex = self.ids.get(curr)
+        if vertex is None:
+            vertex = self.ids[curr] = len(self.names)
+            self.names.append(curr)
+            self.degree.append(0)
+        return vertex
 
     def add_edge(self, curr1, curr2, price):
         """
         adds two new edges to the graph : (curr1, curr2, -log(price))
-        and (curr2, curr1, log(price)) to the graph dictionary
+        and (curr2, curr1, log(price)), or updates their weights.
+        The two edges take two adjacent slots, slot and slot ^ 1
         """
         rate = -1 * math.log(price)
-        if curr1 not in self.graph.keys():
-            self.graph[curr1] = {curr2: rate}
-        else:
-            self.graph[curr1][curr2] = rate
-
-        if curr2 not in self.graph.keys():
-            self.graph[curr2] = {curr1: -1 * rate}
+        self.view = None
+        slot = self.edge_slots.get((curr1, curr2))
+        if slot is not None:  # a new price for a cross already there, the usual case
+            self.weights[slot] = rate
+            self.weights[slot ^ 1] = -1 * rate
+            return
+        u, v = self.vertex(curr1), self.vertex(curr2)
+        if self.free:
+            slot = self.free.pop()
+            self.sources[slot], self.targets[slot], self.weights[slot] = u, v, rate
+            self.sources[slot + 1], self.targets[slot + 1], self.weights[slot + 1] = v, u, -1 * rate
         else:
-            self.graph[curr2][curr1] = -1 * rate
+            slot = len(self.sources)
+            self.sources.extend((u, v))
+            self.targets.extend((v, u))
+            self.weights.extend((rate, -1 * rate))
+        self.edge_slots[curr1, curr2] = slot
+        self.edge_slots[curr2, curr1] = slot + 1
+        self.degree[u] += 1
+        self.degree[v] += 1
+        self.layout_stale = True
 
     def get_graph(self):
-        """returns a reference to the current graph object"""
-        return self.graph
-    
+        """
+        returns the graph as a dictionary {c1: {c2: weight, c3: weight}, c2: {...}, ...},
+        built from the arrays and shared by the calls until the graph changes
+        """
+        if self.view is None:
+            names, targets, weights = self.names, self.targets, self.weights
+            graph = {}
+            for slot, u in enumerate(self.sources):
+                if u >= 0:
+                    graph.setdefault(names[u], {})[names[targets[slot]]] = weights[slot]
+            self.view = graph
+        return self.view
+
     def remove_edge(self, curr1, curr2):
         """removes the two edges (curr1,curr2) and (curr2,curr1)"""
-        if curr1 not in self.graph:
-            print(f'Invalid removal, \'{curr1}\' doesn\'t exist in graph')
-            return
-        if curr2 not in self.graph:
-            print(f'Invalid removal, \'{curr2}\' doesn\'t exist in graph')
+        for curr in (curr1, curr2):
+            if curr not in self.ids or self.degree[self.ids[curr]] == 0:
+                print(f'Invalid removal, \'{curr}\' doesn\'t exist in graph')
+                return
+        slot = self.edge_slots.pop((curr1, curr2), None)
+        if slot is None:
+            print(f'Invalid removal, (\'{curr1}\', \'{curr2}\') doesn\'t exist in graph')
             return
-
-        del self.graph[curr1][curr2]
-        del self.graph[curr2][curr1]
-
-        if len(self.graph[curr1]) == 0 :
-            del self.graph[curr1]
-        if len(self.graph[curr2]) == 0 :
-            del self.graph[curr2]
-  
+        del self.edge_slots[curr2, curr1]
+        u, v = self.ids[curr1], self.ids[curr2]
+        self.sources[slot] = self.sources[slot ^ 1] = -1
+        self.free.append(slot & ~1)
+        self.degree[u] -= 1
+        self.degree[v] -= 1
+        self.layout_stale = True
+        self.view = None
 
     def get_nodes(self):
         """returns list of nodes in the graph"""
-        return list(self.graph.keys())
-    
+        return [curr for curr, degree in zip(self.names, self.degree) if degree]
+
+    def layout(self):
+        """rebuilds the CSR offsets and adjacency if edges came or went, returns the vertices with edges"""
+        if self.layout_stale:
+            n = len(self.names)
+            offsets = array('i', [0]) * (n + 1)
+            for u in range(n):
+                offsets[u + 1] = offsets[u] + self.degree[u]
+            fill = offsets[:n]
+            adjacency = array('i', [0]) * offsets[n]
+            for slot, u in enumerate(self.sources):
+                if u >= 0:
+                    adjacency[fill[u]] = slot
+                    fill[u] += 1
+            self.offsets, self.adjacency = offsets, adjacency
+            self.layout_stale = False
+        return [u for u, degree in enumerate(self.degree) if degree]
+
     def shortest_paths(self, start_vertex, tolerance=0):
         """
         Runs Bellman Ford shortest path algorithm on the graph starting at @start_vertex
         to detect negative cycle, a tolerance value is added to solve floating number rounding
-        errors
+        errors. Returns the distances and predecessors as dictionaries keyed by currency,
+        and the first edge found still relaxable after V - 1 rounds as (u, v), or None
         """
-        # Dictionary to store lowest sum of edge weights
-        distances = {}
+        vertices = self.layout()
+        n = len(self.names)
+        distances, predecessor = self.path_distances, self.path_predecessor
+        if len(distances) < n:
+            distances.extend([INF] * (n - len(distances)))
+            predecessor.extend([-1] * (n - len(predecessor)))
+        for u in vertices:
+            distances[u] = INF
+            predecessor[u] = -1
+        start = self.ids[start_vertex]
+        distances[start] = 0
 
-        for curr in self.graph.keys():
-            distances[curr] = float("Inf")
+        # both tolerance checks of an edge relaxation amount to beating the distance by |tolerance|
+        margin = abs(tolerance)
+        offsets, adjacency, targets, weights = self.offsets, self.adjacency, self.targets, self.weights
+        negative_cycle = None
+        for rounds in range(len(vertices)):  # V - 1 rounds to relax, one more to look for a negative cycle
+            changed = False
+            for u in vertices:
+                du = distances[u]
+                if du == INF:
+                    continue
+                for slot in adjacency[offsets[u]:offsets[u + 1]]:
+                    v = targets[slot]
+                    if du + weights[slot] + margin < distances[v]:
+                        if rounds == len(vertices) - 1:
+                            negative_cycle = (self.names[u], self.names[v])
+                            break
+                        distances[v] = du + weights[slot]
+                        predecessor[v] = u
+                        changed = True
+                if negative_cycle is not None:
+                    break
+            if not changed:
+                break  # nothing moved, so nothing will in the rounds left either
 
-        distances[start_vertex] = 0
+        names = self.names
+        return ({names[u]: distances[u] for u in vertices},
+                dict([(start_vertex, None)] + [(names[u], names[predecessor[u]])
+                                               for u in vertices if predecessor[u] >= 0]),
+                negative_cycle)
 
-        V = len(self.graph) #number of vertices in the graph
 
-        predecessor = {start_vertex : None}
-        for _ in range(V - 1):
-            for u, v_dict in self.graph.items():
-                for v, weight in v_dict.items():
-                    #relaxe edges if possible
-                    if distances[u] != float("Inf") and distances[u] + weight - tolerance < distances[v] and distances[u] + weight + tolerance < distances[v]:
-                        distances[v] = distances[u] + weight
-                        predecessor[v] = u
+class DynamicBellmanFord(BellmanFord):
+    """
+    BellmanFord that keeps its distances between updates, as if a virtual source
+    had a 0-weight edge to every vertex. Only vertices with an out-edge that got
+    cheaper than the stored distances allow are re-relaxed (SPFA queue), so
+    detect_negative_cycle costs about the size of the update, not of the graph.
 
-        negative_cycle = None
+    >>> bf = DynamicBellmanFord()
+    >>> bf.add_edge('USD', 'GBP', 0.8); bf.add_edge('GBP', 'EUR', 1.25); bf.add_edge('EUR', 'USD', 1.0)
+    >>> bf.detect_negative_cycle(1e-9) is None
+    True
+    >>> bf.add_edge('EUR', 'USD', 1.2)
+    >>> bf.detect_negative_cycle(1e-9)
+    ['EUR', 'USD', 'GBP', 'EUR']
+    """
+    __slots__ = ('distances', 'predecessor', 'pending', 'queued', 'dirty')
+
+    def __init__(self):
+        super().__init__()
+        # lists rather than arrays: these are read and written on every relaxation and a list
+        # hands out its float objects without boxing a new one each time
+        self.distances = []  # vertex id -> distance from the virtual source
+        self.predecessor = []  # vertex id -> vertex id it was last relaxed from, -1 if none
+        self.pending = deque()  # vertices whose out-edges need relaxing
+        self.queued = bytearray()  # vertex id -> 1 if it is in pending
+        self.dirty = False  # distances ran into a negative cycle and must be rebuilt
+
+    def add_edge(self, curr1, curr2, price):
+        """adds the two edges and queues whichever endpoint now violates the distances"""
+        super().add_edge(curr1, curr2, price)
+        grow = len(self.names) - len(self.distances)
+        if grow > 0:
+            self.distances.extend([0.0] * grow)
+            self.predecessor.extend([-1] * grow)
+            self.queued.extend(bytes(grow))
+        u, v = self.ids[curr1], self.ids[curr2]
+        rate = self.weights[self.edge_slots[curr1, curr2]]
+        if self.distances[u] + rate < self.distances[v]:
+            self.enqueue(u)
+        if self.distances[v] - rate < self.distances[u]:
+            self.enqueue(v)
+
+    def remove_edge(self, curr1, curr2):
+        """
+        removes the two edges, distances stay valid since removing an edge
+        can only make them larger
+        """
+        super().remove_edge(curr1, curr2)
+        for curr in (curr1, curr2):
+            vertex = self.ids.get(curr)
+            if vertex is not None and self.degree[vertex] == 0:
+                self.distances[vertex] = 0
+                self.predecessor[vertex] = -1
+
+    def enqueue(self, vertex):
+        if not self.queued[vertex]:
+            self.queued[vertex] = 1
+            self.pending.append(vertex)
+
+    def detect_negative_cycle(self, tolerance=0):
+        """
+        Relaxes edges out of the queued vertices until the distances are consistent again.
+        Returns a negative cycle as a list of vertices starting and ending at the same one,
+        e.g. ['USD', 'GBP', 'EUR', 'USD'], or None if there isn't one
+        """
+        vertices = self.layout()
+        distances, predecessor, degree = self.distances, self.predecessor, self.degree
+        if self.dirty:
+            self.dirty = False
+            for vertex in vertices:
+                distances[vertex] = 0
+                predecessor[vertex] = -1
+                self.enqueue(vertex)
+
+        V = len(vertices)
+        offsets, adjacency, targets, weights = self.offsets, self.adjacency, self.targets, self.weights
+        pending, queued = self.pending, self.queued
+        chain = {}  # number of relaxations leading to each vertex in this run
+        while pending:
+            u = pending.popleft()
+            queued[u] = 0
+            if not degree[u]:
+                continue
+            du = distances[u]
+            links = chain.get(u, 0) + 1
+            for slot in adjacency[offsets[u]:offsets[u + 1]]:
+                v = targets[slot]
+                candidate = du + weights[slot]
+                if candidate < distances[v] - tolerance:
+                    distances[v] = candidate
+                    predecessor[v] = u
+                    chain[v] = links
+                    # a relaxation chain of V edges repeats a vertex, so a negative cycle exists
+                    if links % V == 0:
+                        cycle = self.predecessor_cycle(v, tolerance)
+                        if cycle is not None:
+                            for vertex in pending:
+                                queued[vertex] = 0
+                            pending.clear()
+                            self.dirty = True
+                            return cycle
+                    if not queued[v]:
+                        queued[v] = 1
+                        pending.append(v)
+        return None
+
+    def predecessor_cycle(self, vertex, tolerance=0):
+        """
+        Follows predecessors from the vertex id @vertex and returns the cycle they lead
+        into, as currencies in exchange order, if it is a negative cycle in the current graph
+        """
+        seen = set()
+        while vertex >= 0 and vertex not in seen:
+            seen.add(vertex)
+            vertex = self.predecessor[vertex]
+        if vertex < 0:
+            return None
+
+        cycle = [vertex]
+        v = self.predecessor[vertex]
+        while v != vertex:
+            cycle.append(v)
+            v = self.predecessor[v]
+        cycle.append(vertex)
+        cycle.reverse()
+
+        total = 0
+        for u, v in zip(cycle, cycle[1:]):
+            slot = self.edge_slots.get((self.names[u], self.names[v]))
+            if slot is None:
+                return None
+            total += self.weights[slot]
+        return [self.names[v] for v in cycle] if total < -tolerance else None
+
+
+class MatrixBellmanFord(object):
+    """
+    Arbitrage engine for large currency sets: currencies are mapped to integer ids
+    and the -log(price) weights kept in a dense NumPy matrix (inf where there is no
+    edge). Detection runs Bellman Ford from a virtual 0-weight super source and
+    relaxes every edge at once each round. Distances are kept warm between calls,
+    so a tick that only moved a few prices converges in a couple of rounds.
+    Needs numpy, so its examples are in __test__ and only run where numpy is installed.
+    """
+    def __init__(self, capacity=16):
+        if np is None:
+            raise ImportError('MatrixBellmanFord needs numpy')
+        self.ids = {}  # currency -> row/column in the matrix
+        self.names = []  # id -> currency
+        self.degree = np.zeros(capacity, dtype=np.int64)  # number of edges out of each id
+        self.weights = np.full((capacity, capacity), np.inf)
+        self.distances = np.zeros(capacity)
+        self.predecessor = np.full(capacity, -1, dtype=np.int64)
+
+    def currency_id(self, curr):
+        """returns the id of @curr, growing the matrix if it is a new currency"""
+        curr_id = self.ids.get(curr)
+        if curr_id is not None:
+            return curr_id
+        curr_id = self.ids[curr] = len(self.names)
+        self.names.append(curr)
+        capacity = len(self.degree)
+        if curr_id >= capacity:
+            weights = np.full((2 * capacity, 2 * capacity), np.inf)
+            weights[:capacity, :capacity] = self.weights
+            self.weights = weights
+            self.degree = np.concatenate((self.degree, np.zeros(capacity, dtype=np.int64)))
+            self.distances = np.concatenate((self.distances, np.zeros(capacity)))
+            self.predecessor = np.concatenate((self.predecessor, np.full(capacity, -1, dtype=np.int64)))
+        return curr_id
+
+    def add_edge(self, curr1, curr2, price):
+        """sets the edges (curr1, curr2, -log(price)) and (curr2, curr1, log(price))"""
+        i, j = self.currency_id(curr1), self.currency_id(curr2)
+        rate = -1 * math.log(price)
+        if np.isinf(self.weights[i, j]):
+            self.degree[i] += 1
+            self.degree[j] += 1
+        self.weights[i, j] = rate
+        self.weights[j, i] = -1 * rate
+
+    def remove_edge(self, curr1, curr2):
+        """removes the two edges (curr1,curr2) and (curr2,curr1)"""
+        i, j = self.ids.get(curr1), self.ids.get(curr2)
+        if i is None or j is None or np.isinf(self.weights[i, j]):
+            print(f'Invalid removal, (\'{curr1}\', \'{curr2}\') doesn\'t exist in graph')
+            return
+        self.weights[i, j] = self.weights[j, i] = np.inf
+        self.degree[i] -= 1
+        self.degree[j] -= 1
+
+    def get_graph(self):
+        """returns the graph as a dictionary like BellmanFord.graph, built from the matrix"""
+        return matrix_graph(self.weights, self.names)
+
+    def get_nodes(self):
+        """returns list of nodes in the graph"""
+        return [self.names[i] for i in np.nonzero(self.degree[:len(self.names)])[0]]
+
+    def detect_negative_cycle(self, tolerance=0):
+        """
+        Relaxes all edges at once until no distance improves. Returns a negative cycle
+        as a list of currencies starting and ending at the same one, or None
+        """
+        n = len(self.names)
+        weights = self.weights[:n, :n]
+        distances = self.distances[:n]
+        predecessor = self.predecessor[:n]
+        columns = np.arange(n)
+        for rounds in range(1, n + 1):
+            candidates = distances[:, None] + weights
+            best_from = candidates.argmin(axis=0)
+            best = candidates[best_from, columns]
+            improved = np.nonzero(best < distances - tolerance)[0]
+            if len(improved) == 0:
+                return None
+            distances[improved] = best[improved]
+            predecessor[improved] = best_from[improved]
+            # still improving after n rounds means there is a cycle, before that a cheap look is enough
+            for vertex in (improved if rounds == n else improved[:1]):
+                cycle = self.predecessor_cycle(vertex, tolerance)
+                if cycle is not None:
+                    # distances along the cycle are now meaningless, start over next time
+                    distances[:] = 0
+                    predecessor[:] = -1
+                    return cycle
+        return None
+
+    def predecessor_cycle(self, vertex, tolerance=0):
+        """returns the negative cycle the predecessors of @vertex lead into, if any"""
+        n = len(self.names)
+        seen = set()
+        while vertex >= 0 and vertex not in seen and len(seen) <= n:
+            seen.add(vertex)
+            vertex = int(self.predecessor[vertex])
+        if vertex < 0 or vertex not in seen:
+            return None
+
+        cycle = [vertex]
+        v = int(self.predecessor[vertex])
+        while v != vertex:
+            cycle.append(v)
+            v = int(self.predecessor[v])
+        cycle.append(vertex)
+        cycle.reverse()
+
+        total = sum(self.weights[u, v] for u, v in zip(cycle, cycle[1:]))
+        if not total < -tolerance:
+            return None
+        return [self.names[v] for v in cycle]
+
+
+# doctests for MatrixBellmanFord, which can't run without numpy
+__test__ = {} if np is None else {'MatrixBellmanFord': """
+    >>> bf = MatrixBellmanFord()
+    >>> bf.add_edge('USD', 'GBP', 0.8); bf.add_edge('GBP', 'EUR', 1.25); bf.add_edge('EUR', 'USD', 1.2)
+    >>> bf.detect_negative_cycle(1e-9)
+    ['GBP', 'EUR', 'USD', 'GBP']
+
+    On the same quotes it finds the same cycle as DynamicBellmanFord, up to where it starts:
 
-        for u, v_dict in self.graph.items():
-            for v, weight in v_dict.items():
-                if distances[u] != float("Inf") and distances[u] + weight - tolerance < distances[v] and distances[u] + weight + tolerance < distances[v]:
-                    negative_cycle = (u, v)
-                    return distances, predecessor, negative_cycle
-        
-        return distances, predecessor, negative_cycle
+    >>> quotes = [('USD', 'GBP', 0.8), ('GBP', 'EUR', 1.15), ('EUR', 'USD', 1.0), ('USD', 'JPY', 150.0),
+    ...           ('JPY', 'CHF', 0.006), ('CHF', 'USD', 1.05), ('EUR', 'CHF', 0.95), ('GBP', 'JPY', 187.5)]
+    >>> matrix, reference = MatrixBellmanFord(capacity=2), DynamicBellmanFord()
+    >>> for curr1, curr2, price in quotes:
+    ...     matrix.add_edge(curr1, curr2, price); reference.add_edge(curr1, curr2, price)
+    >>> cycle, expected = matrix.detect_negative_cycle(1e-9), reference.detect_negative_cycle(1e-9)
+    >>> cycle, expected
+    (['GBP', 'USD', 'CHF', 'EUR', 'GBP'], ['USD', 'CHF', 'EUR', 'GBP', 'USD'])
+    >>> any(cycle[:-1] == expected[start:-1] + expected[:start] for start in range(len(expected) - 1))
+    True
+    """}
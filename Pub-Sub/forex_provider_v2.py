@@ -4,19 +4,87 @@ Forex Provider
 
 This module implements a staging version the Forex Provider price feed on localhost.
 """
+import argparse
+import functools
+import itertools
 import socket
 import selectors
+import string
 from datetime import datetime, timedelta
 import time
 import random
+import heapq
+import queue
+import threading
 import fxp_bytes
-import fxp_bytes_subscriber
 
 
 REQUEST_ADDRESS = ('localhost', 50403)
 REQUEST_SIZE = 12
 REVERSE_QUOTED = {'GBP', 'EUR', 'AUD'}
 SUBSCRIPTION_TIME = 10 * 60  # seconds
+SENDER_THREADS = 4  # threads sending datagrams to subscribers, off the selector thread
+MULTICAST_GROUP = None  # e.g. ('239.192.0.1', 50404) to send each datagram once to a multicast group
+MULTICAST_TTL = 1  # hops multicast datagrams may travel, 1 keeps them on the local network
+COMPACT_FEED = False  # send the delta-compressed feed (fxp_bytes.DeltaEncoder) instead of 32-byte records
+
+# LoadTestPublisher defaults
+LOAD_CURRENCIES = 200  # currencies quoted, USD included
+LOAD_QUOTES_PER_SECOND = 10_000
+LOAD_TICK = 0.01  # seconds between publishes
+BURST_FACTOR = 1.0  # quote rate multiplier during a burst, 1 means no bursts
+BURST_PERIOD = 5.0  # seconds from the start of one burst to the start of the next
+BURST_LENGTH = 0.5  # seconds a burst lasts
+ARBITRAGE_RATE = 1.0  # arbitrage cycles put in per second
+ARBITRAGE_EDGE = 0.005  # how far off (as a fraction) the price that opens an arbitrage is
+OUT_OF_ORDER_RATIO = 0.01  # fraction of quotes sent with an older timestamp
+OUT_OF_ORDER_DELAY = 0.5  # most seconds an out-of-order quote's timestamp is set back
+CROSS_RATIO = 0.5  # fraction of quotes between two non-USD currencies rather than against USD
+# standard deviation of each fresh USD quote's move, a fraction of its price. Crosses already sent
+# drift from it by about LOAD_VOLATILITY * sqrt(moves per currency while they are fresh), kept well
+# under ARBITRAGE_EDGE so the cycles put in on purpose stand out (given a subscriber MIN_PROFIT)
+LOAD_VOLATILITY = 0.00001
+
+
+class SenderPool(object):
+    """
+    Sends datagrams to subscribers from a few worker threads. Each subscriber always
+    belongs to the same worker so its datagrams keep their order, and each worker
+    sends a whole datagram to all its subscribers in one go.
+    """
+    def __init__(self, sock, threads=SENDER_THREADS):
+        self.socket = sock
+        self.partitions = [set() for _ in range(threads)]
+        self.snapshots = [() for _ in range(threads)]  # tuple copies handed to workers, rebuilt on change
+        self.queues = [queue.Queue() for _ in range(threads)]
+        for work in self.queues:
+            threading.Thread(target=self.send_forever, args=(work,), daemon=True).start()
+
+    def partition(self, subscriber):
+        return self.partitions[hash(subscriber) % len(self.partitions)]
+
+    def add(self, subscriber):
+        self.partition(subscriber).add(subscriber)
+        self.snapshots = [tuple(part) for part in self.partitions]
+
+    def remove(self, subscriber):
+        self.partition(subscriber).discard(subscriber)
+        self.snapshots = [tuple(part) for part in self.partitions]
+
+    def send(self, message):
+        """queues @message (bytes) for every subscriber, returns without waiting for the sends"""
+        for work, subscribers in zip(self.queues, self.snapshots):
+            if subscribers:
+                work.put((message, subscribers))
+
+    def send_forever(self, work):
+        while True:
+            message, subscribers = work.get()
+            for subscriber in subscribers:
+                try:
+                    self.socket.sendto(message, subscriber)
+                except OSError as e:
+                    print('failed to publish to {}: {}'.format(subscriber, e))
 
 
 class TestPublisher(object):
@@ -25,14 +93,34 @@ class TestPublisher(object):
     Updated to ensure 4-way cycle markets are always in same order 
       e.g.  always CAD/EUR, not sometimes EUR/CAD
     """
-    def __init__(self):
-        self.subscriptions = {}
+    def __init__(self, sender_threads=SENDER_THREADS, multicast_group=MULTICAST_GROUP, compact=COMPACT_FEED):
+        self.subscriptions = {}  # subscriber -> time.monotonic() its subscription expires
+        self.expiries = []  # heap of (expiry, subscriber), entries no longer in subscriptions are skipped
         self.socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
         self.reference = {'GBP': 1.25, 'JPY': 100.0, 'EUR': 1.10, 'CHF': 1.00, 'AUD': 0.75}
+        epoch = int(time.time()) & 0xFFFFFFFF  # numbers datagrams for gap detection
+        self.encoder = fxp_bytes.DeltaEncoder(epoch) if compact else fxp_bytes.QuoteEncoder(epoch=epoch)
+        self.multicast_group = multicast_group
+        if multicast_group is not None:
+            self.socket.setsockopt(socket.IPPROTO_IP, socket.IP_MULTICAST_TTL, MULTICAST_TTL)
+        self.senders = SenderPool(self.socket, sender_threads)
 
     def register_subscription(self, subscriber):
         print('registering subscription for {}'.format(subscriber))
-        self.subscriptions[subscriber] = datetime.utcnow()
+        expiry = time.monotonic() + SUBSCRIPTION_TIME
+        self.subscriptions[subscriber] = expiry
+        heapq.heappush(self.expiries, (expiry, subscriber))
+        self.senders.add(subscriber)
+
+    def expire_subscriptions(self):
+        """removes the subscriptions that are due, only looking at those at the front of the heap"""
+        now = time.monotonic()
+        while self.expiries and self.expiries[0][0] <= now:
+            expiry, subscriber = heapq.heappop(self.expiries)
+            if self.subscriptions.get(subscriber) == expiry:  # otherwise it renewed since
+                print('{} subscription expired'.format(subscriber))
+                del self.subscriptions[subscriber]
+                self.senders.remove(subscriber)
 
     @staticmethod
     # ensure market names always in correct order, alpha sort e.g. CAD/EUR
@@ -47,11 +135,8 @@ class TestPublisher(object):
 
     def publish(self):
         # remove expired subscriptions
+        self.expire_subscriptions()
         ts = datetime.utcnow()
-        for subscriber in set(self.subscriptions):
-            if (ts - self.subscriptions[subscriber]).total_seconds() >= SUBSCRIPTION_TIME:
-                print('{} subscription expired'.format(subscriber))
-                del self.subscriptions[subscriber]
         if len(self.subscriptions) == 0:
             print('no subscriptions')
             # return 1000.0  # nothing to do until we get a subscription, so we can wait a long time
@@ -94,22 +179,125 @@ class TestPublisher(object):
                 market_name = TestPublisher.format_market_order("CAD",yyy)
                 quotes.append({'cross': '{}'.format(market_name), 'price': rate*2})
 
-        # send the messages to current subscribers
-        print("before")
-        print(quotes)
-        message = fxp_bytes.marshal_message(quotes)
-        print("after")
-        print(message)
-        print("#DEBUG")
-        print(fxp_bytes_subscriber.unmarshal_message(message))
-
-        for subscriber in self.subscriptions:
-            print('publishing {} to {}'.format(quotes, subscriber))
-            self.socket.sendto(message, subscriber)
+        print('publishing {} to {} subscribers'.format(quotes, len(self.subscriptions)))
+        self.send(self.encoder.encode(quotes))
 
         # pick a time to wait until the next message
         return 1.0  # FIXME randomize quiet time
 
+    def send(self, datagrams):
+        """sends the @datagrams from the encoder to current subscribers, the sender threads do the actual sends"""
+        for message in datagrams:
+            if self.multicast_group is not None:
+                self.socket.sendto(message, self.multicast_group)
+            else:
+                self.senders.send(bytes(message))  # the encoder reuses its buffer for the next datagram
+
+
+def currency_codes(count):
+    """
+    Returns @count distinct 3-letter currency codes other than USD, the real ones first
+
+    >>> currency_codes(7)
+    ['GBP', 'JPY', 'EUR', 'CHF', 'AUD', 'CAD', 'AAA']
+    """
+    codes = ['GBP', 'JPY', 'EUR', 'CHF', 'AUD', 'CAD']
+    made_up = (''.join(letters) for letters in itertools.product(string.ascii_uppercase, repeat=3))
+    for code in made_up:
+        if len(codes) >= count:
+            break
+        if code != 'USD' and code not in codes:
+            codes.append(code)
+    return codes[:count]
+
+
+class LoadTestPublisher(TestPublisher):
+    """
+    Publishes quotes for many currencies at a steady rate, with optional bursts,
+    to stress subscribers. Every LOAD_TICK it sends as many quotes as the rate calls for,
+    each one a random walk of a USD quote or a cross between two other currencies
+    priced from the USD quotes last sent for them. Back-dated quotes repeat the last
+    price sent, so a subscriber ignoring them still holds the legs the crosses were
+    priced from. Apart from the cycles put in on purpose at @arbitrage_rate per second,
+    the only mispricing is a USD quote walking on after crosses on it were sent, see
+    LOAD_VOLATILITY
+    """
+    def __init__(self, currencies=LOAD_CURRENCIES, quotes_per_second=LOAD_QUOTES_PER_SECOND,
+                 burst_factor=BURST_FACTOR, burst_period=BURST_PERIOD, burst_length=BURST_LENGTH,
+                 arbitrage_rate=ARBITRAGE_RATE, out_of_order_ratio=OUT_OF_ORDER_RATIO,
+                 sender_threads=SENDER_THREADS, multicast_group=MULTICAST_GROUP, compact=COMPACT_FEED):
+        super().__init__(sender_threads, multicast_group, compact)
+        # units of each currency per USD as last sent, so every cross is quoted as USD/XXX
+        self.reference = {code: random.uniform(0.5, 150.0) for code in currency_codes(currencies - 1)}
+        self.currencies = list(self.reference)
+        self.quotes_per_second = quotes_per_second
+        self.burst_factor = burst_factor
+        self.burst_period = burst_period
+        self.burst_length = burst_length
+        self.arbitrage_rate = arbitrage_rate
+        self.out_of_order_ratio = out_of_order_ratio
+        self.started = self.last_publish = self.last_report = time.monotonic()
+        self.quotes_owed = self.arbitrages_owed = 0.0  # fractions carried over to the next publish
+        self.published = self.arbitrages = 0  # since the last report
+
+    def quote_rate(self, now):
+        """quotes per second to send at monotonic time @now, higher during a burst"""
+        if (now - self.started) % self.burst_period < self.burst_length:
+            return self.quotes_per_second * self.burst_factor
+        return self.quotes_per_second
+
+    def publish(self):
+        self.expire_subscriptions()
+        now = time.monotonic()
+        elapsed, self.last_publish = now - self.last_publish, now
+        self.quotes_owed += self.quote_rate(now) * elapsed
+        self.arbitrages_owed += self.arbitrage_rate * elapsed
+        count, arbitrages = int(self.quotes_owed), int(self.arbitrages_owed)
+        self.quotes_owed -= count
+        self.arbitrages_owed -= arbitrages
+
+        timestamp = fxp_bytes.utcdatetime_micros(datetime.utcnow())
+        timestamps, crosses, prices = [], [], []
+        reference = self.reference
+        for ccy in random.choices(self.currencies, k=count):
+            late = random.random() < self.out_of_order_ratio
+            if random.random() < CROSS_RATIO:
+                other = random.choice(self.currencies)
+                if other == ccy:
+                    continue
+                first, second = sorted((ccy, other))
+                crosses.append('{}/{}'.format(first, second))
+                prices.append(reference[second] / reference[first])
+            else:
+                if not late:  # only a fresh quote moves the market, see above
+                    reference[ccy] *= random.gauss(1.0, LOAD_VOLATILITY)
+                crosses.append('USD/' + ccy)
+                prices.append(reference[ccy])
+            if late:
+                timestamps.append(timestamp - int(random.uniform(0, OUT_OF_ORDER_DELAY) * fxp_bytes.MICROS_PER_SECOND))
+            else:
+                timestamps.append(timestamp)
+
+        # a 3-way cycle through USD with the cross priced a little off
+        for _ in range(arbitrages):
+            first, second = sorted(random.sample(self.currencies, 2))
+            edge = random.choice((1 - ARBITRAGE_EDGE, 1 + ARBITRAGE_EDGE))
+            crosses.extend(('USD/' + first, 'USD/' + second, '{}/{}'.format(first, second)))
+            prices.extend((reference[first], reference[second], reference[second] / reference[first] * edge))
+            timestamps.extend((timestamp, timestamp, timestamp))
+
+        self.published += len(crosses)
+        self.arbitrages += arbitrages
+        if now - self.last_report >= 1.0:
+            print('published {:.0f} quotes/s with {} arbitrage cycles to {} subscribers'.format(
+                self.published / (now - self.last_report), self.arbitrages, len(self.subscriptions)))
+            self.published = self.arbitrages = 0
+            self.last_report = now
+        if self.subscriptions or self.multicast_group is not None:
+            self.send(self.encoder.encode_columns(timestamps, crosses, prices))
+
+        return max(0.0, now + LOAD_TICK - time.monotonic())
+
 
 class ForexProvider(object):
     """
@@ -161,5 +349,24 @@ if __name__ == '__main__':
     # t = TestPublisher()
     # t.publish()
     
-    fxp = ForexProvider(REQUEST_ADDRESS, TestPublisher)
+    parser = argparse.ArgumentParser(description='staging Forex Provider price feed on localhost')
+    parser.add_argument('--load', action='store_true', help='publish at a high rate with LoadTestPublisher')
+    parser.add_argument('--currencies', type=int, default=LOAD_CURRENCIES, help='currencies quoted under --load')
+    parser.add_argument('--rate', type=float, default=LOAD_QUOTES_PER_SECOND, help='quotes per second under --load')
+    parser.add_argument('--burst-factor', type=float, default=BURST_FACTOR, help='quote rate multiplier during bursts')
+    parser.add_argument('--burst-period', type=float, default=BURST_PERIOD, help='seconds between burst starts')
+    parser.add_argument('--burst-length', type=float, default=BURST_LENGTH, help='seconds each burst lasts')
+    parser.add_argument('--arbitrage-rate', type=float, default=ARBITRAGE_RATE, help='arbitrage cycles per second')
+    parser.add_argument('--out-of-order', type=float, default=OUT_OF_ORDER_RATIO,
+                        help='fraction of quotes sent with an older timestamp')
+    parser.add_argument('--compact', action='store_true', default=COMPACT_FEED,
+                        help='send the delta-compressed feed instead of 32-byte quote records')
+    args = parser.parse_args()
+
+    publisher_class = functools.partial(TestPublisher, compact=args.compact)
+    if args.load:
+        publisher_class = functools.partial(
+            LoadTestPublisher, args.currencies, args.rate, args.burst_factor, args.burst_period,
+            args.burst_length, args.arbitrage_rate, args.out_of_order, compact=args.compact)
+    fxp = ForexProvider(REQUEST_ADDRESS, publisher_class)
     fxp.run_forever()
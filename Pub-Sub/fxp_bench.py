@@ -0,0 +1,111 @@
+"""
+Forex Provider Benchmarks
+Measures the per-quote cost of encoding and decoding Forex Provider messages,
+and what the compact feed saves over 32-byte records.
+Run python3 fxp_bench.py
+:Authors: Noha Nomier
+"""
+import random
+import timeit
+from datetime import datetime, timedelta
+
+import fxp_bytes
+import fxp_bytes_subscriber
+
+CURRENCIES = ['USD', 'GBP', 'EUR', 'JPY', 'CHF', 'AUD', 'CAD', 'NZD']
+REPEAT = 200
+COMPACT_CURRENCIES = 200  # currencies quoted in the compact feed comparison
+COMPACT_CROSSES = 500  # distinct crosses quoted
+COMPACT_UNCHANGED = 0.3  # fraction of quotes repeating the previous price of their cross
+
+
+def random_quotes(count):
+    """returns @count random quotes as marshal_message expects them"""
+    now = datetime.utcnow()
+    quotes = []
+    for _ in range(count):
+        curr1, curr2 = random.sample(CURRENCIES, 2)
+        quotes.append({'cross': f'{curr1}/{curr2}', 'price': random.uniform(0.5, 150),
+                       'timestamp': now - timedelta(microseconds=random.randrange(10**6))})
+    return quotes
+
+
+def per_quote_ns(function, argument, quotes, number=REPEAT):
+    """best time over a few runs of @function(@argument), in nanoseconds per quote"""
+    best = min(timeit.repeat(lambda: function(argument), number=number, repeat=5))
+    return best / number / quotes * 1e9
+
+
+def bench_decode():
+    message = fxp_bytes.marshal_message(random_quotes(fxp_bytes.MAX_QUOTES_PER_MESSAGE))
+    quotes = fxp_bytes.MAX_QUOTES_PER_MESSAGE
+    print(f"decoding {quotes}-quote messages (ns per quote)")
+    print(f"unmarshal_message\t{per_quote_ns(fxp_bytes_subscriber.unmarshal_message, message, quotes):.0f}")
+    print(f"unmarshal_records\t{per_quote_ns(fxp_bytes_subscriber.unmarshal_records, message, quotes):.0f}")
+    if fxp_bytes_subscriber.np is not None:
+        print(f"unmarshal_columns\t{per_quote_ns(fxp_bytes_subscriber.unmarshal_columns, message, quotes):.0f}")
+
+
+def bench_encode():
+    quotes = random_quotes(10_000)
+    encoder = fxp_bytes.QuoteEncoder()
+    timestamps = [fxp_bytes.utcdatetime_micros(quote['timestamp']) for quote in quotes]
+    crosses = [quote['cross'] for quote in quotes]
+    prices = [quote['price'] for quote in quotes]
+    batches = [quotes[i:i + fxp_bytes.MAX_QUOTES_PER_MESSAGE]
+               for i in range(0, len(quotes), fxp_bytes.MAX_QUOTES_PER_MESSAGE)]
+
+    def marshal_each(batches):
+        for batch in batches:
+            fxp_bytes.marshal_message(batch)
+
+    def drain(datagrams):
+        for _ in datagrams:
+            pass
+
+    print(f"encoding {len(quotes)} quotes (ns per quote)")
+    print(f"marshal_message\t\t{per_quote_ns(marshal_each, batches, len(quotes)):.0f}")
+    print(f"QuoteEncoder.encode\t{per_quote_ns(lambda q: drain(encoder.encode(q)), quotes, len(quotes)):.0f}")
+    print(f"encode_columns\t\t{per_quote_ns(lambda c: drain(encoder.encode_columns(*c)), (timestamps, crosses, prices), len(quotes)):.0f}")
+
+
+def bench_compact(ticks=1000, quotes_per_tick=100):
+    """
+    Sends the same @ticks batches of quotes through the plain and the compact encoder,
+    with a keyframe every 100 ticks, and compares bytes sent and time to decode the feed
+    """
+    from forex_provider_v2 import currency_codes
+    codes = currency_codes(COMPACT_CURRENCIES - 1)
+    pairs = ['USD/' + code for code in codes]
+    while len(pairs) < COMPACT_CROSSES:
+        pairs.append('/'.join(sorted(random.sample(codes, 2))))
+    plain, compact = fxp_bytes.QuoteEncoder(epoch=1), fxp_bytes.DeltaEncoder(epoch=1, keyframe_interval=float('inf'))
+    now = fxp_bytes.utcdatetime_micros(datetime.utcnow())
+    last_price = {}
+    plain_feed, compact_feed = [], []
+    for tick in range(ticks):
+        if tick % 100 == 0:
+            compact.next_keyframe = 0  # as if KEYFRAME_INTERVAL had passed
+        crosses = random.choices(pairs, k=quotes_per_tick)
+        prices = [last_price[cross] if cross in last_price and random.random() < COMPACT_UNCHANGED
+                  else random.uniform(0.5, 150) for cross in crosses]
+        last_price.update(zip(crosses, prices))
+        timestamps = [now + tick * 10_000] * quotes_per_tick
+        plain_feed.extend(bytes(datagram) for datagram in plain.encode_columns(timestamps, crosses, prices))
+        compact_feed.extend(compact.encode_columns(timestamps, crosses, prices))
+
+    quotes = ticks * quotes_per_tick
+    decoder = fxp_bytes_subscriber.DeltaDecoder()
+    plain_ns = per_quote_ns(lambda feed: [fxp_bytes_subscriber.unmarshal_records(m) for m in feed], plain_feed, quotes, 1)
+    compact_ns = per_quote_ns(lambda feed: [decoder.decode(m) for m in feed], compact_feed, quotes, 1)
+    print(f"{quotes} quotes over {len(pairs)} crosses, {COMPACT_UNCHANGED:.0%} unchanged (per quote published)")
+    print(f"plain feed	{sum(map(len, plain_feed)) / quotes:.1f} bytes	{plain_ns:.0f} ns to decode")
+    print(f"compact feed	{sum(map(len, compact_feed)) / quotes:.1f} bytes	{compact_ns:.0f} ns to decode")
+
+
+if __name__ == '__main__':
+    bench_decode()
+    print()
+    bench_encode()
+    print()
+    bench_compact()
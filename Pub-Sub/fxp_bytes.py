@@ -5,11 +5,30 @@ Forex Provider
 This module contains useful marshalling functions for manipulating Forex Provider packet contents.
 """
 import ipaddress
+import struct
+import time
 from array import array
-from datetime import datetime
+from datetime import datetime, timedelta
 
 MAX_QUOTES_PER_MESSAGE = 50
 MICROS_PER_SECOND = 1_000_000
+QUOTE_SIZE = 32  # bytes per quote record
+EPOCH = datetime(1970, 1, 1)
+ONE_MICROSECOND = timedelta(microseconds=1)
+QUOTE_HEAD = struct.Struct('>Q6s')  # big-endian timestamp then both currency codes
+QUOTE_PRICE = struct.Struct('<d')  # little-endian price right after the currencies
+QUOTE_SEQUENCE = struct.Struct('>II')  # publisher epoch and datagram sequence number in reserved bytes 22-30
+
+# compact feed, see DeltaEncoder
+COMPACT_MARKER = 0xFD  # first byte of a compact datagram, a plain one starts with a timestamp's zero high byte
+COMPACT_KEYFRAME = 0x01  # flag set on the datagrams of a keyframe
+COMPACT_KEY_FORMATS = 'BHI'  # key column item formats, the one used is flagged at bits 1-2
+COMPACT_OFFSET_FORMATS = 'bhiq'  # timestamp offset column item formats, the one used is flagged at bits 3-4
+COMPACT_HEADER = struct.Struct('>BBIIQH')  # marker, flags, epoch, sequence, base timestamp, quote count
+COMPACT_DATAGRAM_SIZE = 1472  # largest compact datagram, what fits in one ethernet frame
+CODES_SIZE = 6  # bytes of the two currency codes sent when a cross id is announced
+KEYFRAME_INTERVAL = 1.0  # seconds between keyframes, under the subscribers' quote timeout
+KEYFRAME_MAX_AGE = 1.5  # seconds, crosses not quoted for longer are stale to subscribers and left out of keyframes
 
 
 def serialize_price(x: float) -> bytes:
@@ -62,7 +81,232 @@ def serialize_utcdatetime(utc: datetime) -> bytes:
     return a.tobytes()
 
 
-def marshal_message(quote_sequence) -> bytes:
+def utcdatetime_micros(utc: datetime) -> int:
+    """
+    Exact number of microseconds between the epoch and the UTC datetime @utc.
+
+    >>> utcdatetime_micros(datetime(1971, 12, 10, 1, 2, 3, 64000))
+    61174923064000
+    """
+    return (utc - EPOCH) // ONE_MICROSECOND
+
+
+class QuoteEncoder(object):
+    """
+    Packs quotes straight into one preallocated buffer that is reused for every
+    datagram, sequences longer than @max_quotes are split over several datagrams.
+    The datagrams are yielded as memoryviews over that buffer, each one is only
+    valid until the next one is produced, so send (or copy) it right away.
+
+    >>> encoder = QuoteEncoder(max_quotes=2)
+    >>> [len(datagram) for datagram in encoder.encode([{'cross': 'GBP/USD', 'price': 1.25}] * 5)]
+    [64, 64, 32]
+    >>> bytes(next(encoder.encode_columns([1136160000000000], ['GBP/USD'], [1.22041])))[:22]
+    b'\\x00\\x04\\tT\\xdd5@\\x00GBPUSD\\xbba\\xdb\\xa2\\xcc\\x86\\xf3?'
+
+    With a non-zero @epoch (something unique to this publisher run, like its start time)
+    every record carries the epoch and the sequence number of its datagram, counting from
+    @sequence, in bytes 22-30 so subscribers can spot lost and reordered datagrams.
+
+    >>> sequenced = QuoteEncoder(max_quotes=1, epoch=7, sequence=1)
+    >>> [bytes(datagram)[22:32] for datagram in sequenced.encode([{'cross': 'GBP/USD', 'price': 1.25}] * 2)]
+    [b'\\x00\\x00\\x00\\x07\\x00\\x00\\x00\\x01\\x00\\x00', b'\\x00\\x00\\x00\\x07\\x00\\x00\\x00\\x02\\x00\\x00']
+    """
+    def __init__(self, max_quotes=MAX_QUOTES_PER_MESSAGE, epoch=0, sequence=1):
+        self.max_quotes = max_quotes
+        self.buffer = bytearray(max_quotes * QUOTE_SIZE)  # bytes 30-32 are never written so stay zero
+        self.view = memoryview(self.buffer)
+        self.crosses = {}  # 'GBP/USD' -> b'GBPUSD'
+        self.epoch = epoch  # 0 leaves the epoch and sequence bytes zero, as in unsequenced feeds
+        self.sequence = sequence if epoch else 0  # sequence number of the next datagram
+
+    def cross_bytes(self, cross):
+        """returns the 6 bytes sent for @cross, e.g. b'GBPUSD' for 'GBP/USD'"""
+        encoded = self.crosses.get(cross)
+        if encoded is None:
+            encoded = self.crosses[cross] = (cross[0:3] + cross[4:7]).encode('utf-8')
+        return encoded
+
+    def encode(self, quote_sequence):
+        """
+        Yields the datagrams for @quote_sequence, a sequence of quote structures ('cross'
+        and 'price', may also have 'timestamp'), quotes without a timestamp get the current time
+        """
+        default_time = utcdatetime_micros(datetime.utcnow())
+        timestamps = [utcdatetime_micros(quote['timestamp']) if 'timestamp' in quote else default_time
+                      for quote in quote_sequence]
+        return self.encode_columns(timestamps, [quote['cross'] for quote in quote_sequence],
+                                   [quote['price'] for quote in quote_sequence])
+
+    def encode_columns(self, timestamps, crosses, prices):
+        """
+        Yields the datagrams for quotes given column by column: @timestamps in microseconds
+        since the epoch, @crosses like 'GBP/USD' and @prices
+        """
+        pack_head, pack_price, pack_sequence = QUOTE_HEAD.pack_into, QUOTE_PRICE.pack_into, QUOTE_SEQUENCE.pack_into
+        buffer, offset = self.buffer, 0
+        for timestamp, cross, price in zip(timestamps, crosses, prices):
+            pack_head(buffer, offset, timestamp, self.cross_bytes(cross))
+            pack_price(buffer, offset + 14, price)
+            pack_sequence(buffer, offset + 22, self.epoch, self.sequence)
+            offset += QUOTE_SIZE
+            if offset == len(buffer):
+                yield self.next_datagram(offset)
+                offset = 0
+        if offset:
+            yield self.next_datagram(offset)
+
+    def next_datagram(self, size):
+        """returns the first @size bytes of the buffer as a datagram and moves on to the next sequence number"""
+        if self.epoch:
+            self.sequence = (self.sequence + 1) & 0xFFFFFFFF
+        return self.view[:size]
+
+
+def key_format(largest):
+    """returns the smallest of COMPACT_KEY_FORMATS holding keys up to @largest"""
+    return 'B' if largest < 1 << 8 else 'H' if largest < 1 << 16 else 'I'
+
+
+def offset_format(largest):
+    """
+    Returns the smallest of COMPACT_OFFSET_FORMATS holding offsets of magnitude up to @largest
+
+    >>> [offset_format(largest) for largest in (0, 127, 128, 10**6, 10**10)]
+    ['b', 'b', 'h', 'i', 'q']
+    """
+    return 'b' if largest < 1 << 7 else 'h' if largest < 1 << 15 else 'i' if largest < 1 << 31 else 'q'
+
+
+class DeltaEncoder(object):
+    """
+    Encodes quotes into the compact feed. Every cross gets a small id for the whole
+    publisher run and, after the first time, a quote only travels when its price changed:
+    as its id, its timestamp as an offset from the datagram's base timestamp and its price.
+    Every @keyframe_interval seconds a keyframe resends every cross quoted in the last
+    KEYFRAME_MAX_AGE seconds with its latest price and its codes, so subscribers that lost
+    datagrams or joined late catch up.
+
+    A compact datagram is a COMPACT_HEADER (COMPACT_MARKER, flags, epoch, sequence,
+    big-endian base timestamp in microseconds, quote count n) followed by three
+    little-endian columns of n items, so a subscriber unpacks each one in a single call:
+    the prices as doubles, the keys (id << 1 | 1 if the cross is announced) as unsigned
+    ints and the signed timestamp offsets from the base timestamp, each column as narrow
+    as its largest item allows (flagged as in COMPACT_KEY_FORMATS and COMPACT_OFFSET_FORMATS).
+    Then come the CODES_SIZE currency code bytes of each announced cross, in order.
+
+    Has the same encode and encode_columns as QuoteEncoder, yielding bytes.
+
+    >>> encoder = DeltaEncoder(epoch=7)
+    >>> [len(datagram) for datagram in encoder.encode_columns([10**15] * 2, ['GBP/USD', 'USD/JPY'], [1.25, 100.0])]
+    [52]
+    >>> [len(datagram) for datagram in encoder.encode_columns([10**15 + 5] * 2, ['GBP/USD', 'USD/JPY'], [1.25, 101.0])]
+    [30]
+    """
+    def __init__(self, epoch=0, sequence=1, keyframe_interval=KEYFRAME_INTERVAL, max_size=COMPACT_DATAGRAM_SIZE):
+        self.epoch = epoch
+        self.sequence = sequence if epoch else 0
+        self.keyframe_interval = keyframe_interval
+        self.max_size = max_size
+        self.ids = {}  # 'GBP/USD' -> cross id
+        self.codes = []  # cross id -> b'GBPUSD'
+        self.prices = []  # cross id -> latest price
+        self.timestamps = []  # cross id -> timestamp of the latest price
+        self.next_keyframe = time.monotonic() + keyframe_interval
+
+    def encode(self, quote_sequence):
+        """Yields the datagrams for @quote_sequence, quote structures as QuoteEncoder.encode takes them"""
+        default_time = utcdatetime_micros(datetime.utcnow())
+        timestamps = [utcdatetime_micros(quote['timestamp']) if 'timestamp' in quote else default_time
+                      for quote in quote_sequence]
+        return self.encode_columns(timestamps, [quote['cross'] for quote in quote_sequence],
+                                   [quote['price'] for quote in quote_sequence])
+
+    def encode_columns(self, timestamps, crosses, prices):
+        """
+        Yields the datagrams for quotes given column by column, as QuoteEncoder.encode_columns
+        takes them: the changed quotes, or a whole keyframe when one is due
+        """
+        entries = []  # (cross id, send its codes, timestamp, price)
+        for timestamp, cross, price in zip(timestamps, crosses, prices):
+            cross_id = self.ids.get(cross)
+            if cross_id is None:
+                cross_id = self.ids[cross] = len(self.codes)
+                self.codes.append((cross[0:3] + cross[4:7]).encode('utf-8'))
+                self.prices.append(price)
+                self.timestamps.append(timestamp)
+                entries.append((cross_id, True, timestamp, price))
+                continue
+            if timestamp >= self.timestamps[cross_id]:  # an older quote doesn't replace the latest one
+                changed = price != self.prices[cross_id]
+                self.prices[cross_id], self.timestamps[cross_id] = price, timestamp
+                if not changed:
+                    continue
+            entries.append((cross_id, False, timestamp, price))
+
+        now = time.monotonic()
+        if now >= self.next_keyframe:
+            self.next_keyframe = now + self.keyframe_interval
+            horizon = utcdatetime_micros(datetime.utcnow()) - int(KEYFRAME_MAX_AGE * MICROS_PER_SECOND)
+            entries = [(cross_id, True, timestamp, self.prices[cross_id])
+                       for cross_id, timestamp in enumerate(self.timestamps) if timestamp >= horizon]
+            return self.datagrams(entries, COMPACT_KEYFRAME)
+        return self.datagrams(entries, 0)
+
+    def datagrams(self, entries, flags):
+        """Yields @entries packed into as few datagrams of at most max_size bytes as they fit in"""
+        start = 0
+        while start < len(entries):
+            base = entries[start][2]
+            largest_key = largest_offset = announced = 0
+            end = start
+            while end < len(entries) and end - start < 0xFFFF:
+                cross_id, with_codes, timestamp, _ = entries[end]
+                key = max(largest_key, cross_id << 1 | with_codes)
+                offset = max(largest_offset, abs(timestamp - base))
+                size = (COMPACT_HEADER.size + CODES_SIZE * (announced + with_codes) + (end + 1 - start) *
+                        (8 + struct.calcsize(key_format(key)) + struct.calcsize(offset_format(offset))))
+                if size > self.max_size and end > start:
+                    break
+                largest_key, largest_offset, announced = key, offset, announced + with_codes
+                end += 1
+            yield self.datagram(entries[start:end], flags)
+            start = end
+
+    def datagram(self, entries, flags):
+        """packs @entries into one datagram and moves on to the next sequence number"""
+        base = entries[0][2]
+        count = len(entries)
+        keys = [cross_id << 1 | with_codes for cross_id, with_codes, _, _ in entries]
+        offsets = [timestamp - base for _, _, timestamp, _ in entries]
+        keys_as = key_format(max(keys))
+        offsets_as = offset_format(max(map(abs, offsets)))
+        flags |= COMPACT_KEY_FORMATS.index(keys_as) << 1 | COMPACT_OFFSET_FORMATS.index(offsets_as) << 3
+        buffer = bytearray(COMPACT_HEADER.pack(COMPACT_MARKER, flags, self.epoch, self.sequence, base, count))
+        buffer += struct.pack('<%dd' % count, *[entry[3] for entry in entries])
+        buffer += struct.pack('<%d%s' % (count, keys_as), *keys)
+        buffer += struct.pack('<%d%s' % (count, offsets_as), *offsets)
+        for cross_id, with_codes, _, _ in entries:
+            if with_codes:
+                buffer += self.codes[cross_id]
+        if self.epoch:
+            self.sequence = (self.sequence + 1) & 0xFFFFFFFF
+        return bytes(buffer)
+
+
+def marshal_messages(quote_sequence, epoch=0, sequence=1) -> list:
+    """
+    Like marshal_message but splits sequences longer than MAX_QUOTES_PER_MESSAGE
+    into as many messages as needed, numbered from @sequence when @epoch is given.
+
+    >>> [len(b) for b in marshal_messages([{'cross': 'GBP/USD', 'price': 1.25}] * 60)]
+    [1600, 320]
+    """
+    encoder = QuoteEncoder(epoch=epoch, sequence=sequence)
+    return [bytes(datagram) for datagram in encoder.encode(quote_sequence)]
+
+
+def marshal_message(quote_sequence, epoch=0, sequence=1) -> bytes:
     """
     Construct the byte stream for a message with given quote_sequence.
 
@@ -76,21 +320,10 @@ def marshal_message(quote_sequence) -> bytes:
     b'\\x00\\x04\\t@\\xbf]\\xe0\\x00USDJPY\\x12\\x83\\xc0\\xca\\xa1\\x11[@\\x00\\x00\\x00\\x00\\x00\\x00\\x00\\x00\\x00\\x00'
 
     :param quote_sequence: list of quote structures ('cross' and 'price', may also have 'timestamp')
+    :param epoch: non-zero id of the publisher run, put in bytes 22-26 of every record with @sequence
+    :param sequence: number of this message in the publisher's feed, put in bytes 26-30
     :return: byte stream to send in UDP message
     """
     if len(quote_sequence) > MAX_QUOTES_PER_MESSAGE:
         raise ValueError('max quotes exceeded for a single message')
-    message = bytes()
-    default_time = serialize_utcdatetime(datetime.utcnow())
-    padding = b'\x00' * 10  # 10 bytes of zeros
-    for quote in quote_sequence:
-        if 'timestamp' in quote:
-            message += serialize_utcdatetime(quote['timestamp'])
-        else:
-            message += default_time
-        message += quote['cross'][0:3].encode('utf-8')
-        message += quote['cross'][4:7].encode('utf-8')
-        message += serialize_price(quote['price'])
-        message += padding
-
-    return message
+    return b''.join(marshal_messages(quote_sequence, epoch, sequence))
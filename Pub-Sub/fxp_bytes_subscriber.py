@@ -5,10 +5,33 @@ sent or received from the subscriber side
 :Authors: Noha Nomier
 """
 import struct
+import sys
 from datetime import datetime ,timedelta
 
+try:
+    import numpy as np
+except ImportError:  # numpy is only needed by unmarshal_columns
+    np = None
+
 SIZE_OF_ONE_MESSAGE = 32 #bytes
 MICROS_PER_SECOND = 1_000_000
+EPOCH = datetime(1970, 1, 1)
+
+# one 32-byte quote: big-endian timestamp (decoded separately), two currencies, little-endian price, padding
+QUOTE_RECORD = struct.Struct('<8s3s3sd10x')
+QUOTE_SEQUENCE = struct.Struct('>II')  # publisher epoch and datagram sequence number at bytes 22-30
+QUOTE_DTYPE = None if np is None else np.dtype([
+    ('timestamp', '>u8'), ('curr1', 'S3'), ('curr2', 'S3'), ('price', '<f8'),
+    ('epoch', '>u4'), ('sequence', '>u4'), ('reserved', 'V2')])
+CURRENCIES = {}  # currency code bytes -> interned str, shared by every decoded quote
+
+# compact feed, laid out as described in fxp_bytes.DeltaEncoder
+COMPACT_MARKER = 0xFD
+COMPACT_KEYFRAME = 0x01
+COMPACT_KEY_FORMATS = 'BHI'  # key column item formats, by flags bits 1-2
+COMPACT_OFFSET_FORMATS = 'bhiq'  # timestamp offset column item formats, by flags bits 3-4
+COMPACT_HEADER = struct.Struct('>BBIIQH')  # marker, flags, epoch, sequence, base timestamp, quote count
+CODES_SIZE = 6
 
 def serialize_address(ip_address, port_number):
     """
@@ -22,6 +45,130 @@ def serialize_address(ip_address, port_number):
     port_as_bytes = struct.pack('>H', port_number)
     return ip_as_bytes + port_as_bytes
 
+def intern_currency(code: bytes) -> str:
+    """returns the one shared str for the 3-byte currency @code"""
+    currency = CURRENCIES.get(code)
+    if currency is None:
+        currency = CURRENCIES[code] = sys.intern(code.decode('utf-8'))
+    return currency
+
+def unmarshal_records(message: bytes) -> list:
+    """
+    Decodes every 32-byte quote in @message without copying it, see unmarshal_message for
+    the layout. Returns (timestamp, curr1, curr2, price) tuples where timestamp is an int
+    number of microseconds since the epoch and the currencies are interned strings
+
+    >>> unmarshal_records(b'\\x00\\x04\\tT\\xdd5@\\x00GBPUSD\\xbba\\xdb\\xa2\\xcc\\x86\\xf3?' + bytes(10))
+    [(1136160000000000, 'GBP', 'USD', 1.22041)]
+    """
+    whole = len(message) - len(message) % SIZE_OF_ONE_MESSAGE
+    from_bytes = int.from_bytes
+    return [(from_bytes(timestamp, 'big'), intern_currency(curr1), intern_currency(curr2), price)
+            for timestamp, curr1, curr2, price in QUOTE_RECORD.iter_unpack(memoryview(message)[:whole])]
+
+def unmarshal_columns(message: bytes):
+    """
+    Decodes @message into a NumPy structured array viewing the message bytes, with
+    columns 'timestamp' (microseconds since the epoch), 'curr1', 'curr2' (3-byte codes)
+    and 'price'. Needs numpy
+    """
+    if np is None:
+        raise ImportError('unmarshal_columns needs numpy')
+    whole = len(message) - len(message) % SIZE_OF_ONE_MESSAGE
+    return np.frombuffer(message, dtype=QUOTE_DTYPE, count=whole // SIZE_OF_ONE_MESSAGE)
+
+def message_sequence(message: bytes) -> tuple:
+    """
+    Returns the (epoch, sequence number) the publisher put in @message, both are 0
+    when the publisher doesn't number its messages or the message is empty
+
+    >>> message_sequence(bytes(22) + b'\\x00\\x00\\x00\\x07\\x00\\x00\\x01\\x00' + bytes(2))
+    (7, 256)
+    """
+    if is_compact(message):
+        return QUOTE_SEQUENCE.unpack_from(message, 2)
+    if len(message) < SIZE_OF_ONE_MESSAGE:
+        return 0, 0
+    return QUOTE_SEQUENCE.unpack_from(message, 22)
+
+def is_compact(message: bytes) -> bool:
+    """tells whether @message is a compact feed datagram rather than 32-byte quote records"""
+    return len(message) >= COMPACT_HEADER.size and message[0] == COMPACT_MARKER
+
+class DeltaDecoder:
+    """
+    Decodes a feed that may be compact (see fxp_bytes.DeltaEncoder), remembering the
+    cross ids announced by the publisher run. Quotes for ids it hasn't been told about,
+    because the datagram announcing them was lost, are dropped and counted in
+    @unknown until the next keyframe announces them again.
+    Plain datagrams are decoded by unmarshal_records.
+
+    >>> decoder = DeltaDecoder()
+    >>> decoder.decode(b'\\xfd\\x00\\x00\\x00\\x00\\x07\\x00\\x00\\x00\\x01\\x00\\x03\\x8d~\\xa4\\xc6\\x80\\x00\\x00\\x01'
+    ...                b'\\x00\\x00\\x00\\x00\\x00\\x00\\xf4?\\x01\\x00GBPUSD')
+    [(1000000000000000, 'GBP', 'USD', 1.25)]
+    >>> decoder.decode(b'\\xfd\\x00\\x00\\x00\\x00\\x07\\x00\\x00\\x00\\x02\\x00\\x03\\x8d~\\xa4\\xc6\\x80\\x05\\x00\\x02'
+    ...                b'\\x00\\x00\\x00\\x00\\x00\\x00\\xf6?\\x00\\x00\\x00\\x00\\x00\\x00\\xf0?\\x00\\x02\\x00\\x00')
+    [(1000000000000005, 'GBP', 'USD', 1.375)]
+    >>> decoder.unknown
+    1
+    >>> decoder.decode(b'\\xfd\\x00\\x00\\x00\\x00\\x07\\x00\\x00\\x00\\x03\\x00\\x03\\x8d~\\xa4\\xc6\\x80\\x05\\x00\\x02\\x00')
+    Traceback (most recent call last):
+    ...
+    ValueError: compact datagram of 21 bytes too short for its 2 quotes
+    """
+    def __init__(self):
+        self.epoch = None  # publisher run the cross ids belong to
+        self.crosses = {}  # cross id -> (curr1, curr2)
+        self.unknown = 0  # quotes dropped because their cross id wasn't announced
+
+    def decode(self, message: bytes) -> list:
+        """
+        Returns the quotes in @message as (timestamp, curr1, curr2, price) tuples, like
+        unmarshal_records. Raises ValueError if @message is truncated or corrupt, so
+        the caller can drop it
+        """
+        if not is_compact(message):
+            if len(message) % SIZE_OF_ONE_MESSAGE:
+                raise ValueError(f'datagram of {len(message)} bytes is not a whole number of quotes')
+            return unmarshal_records(message)
+        _, flags, epoch, _, base, count = COMPACT_HEADER.unpack_from(message)
+        key_format, offset_format = flags >> 1 & 0x03, flags >> 3 & 0x03
+        if key_format >= len(COMPACT_KEY_FORMATS) or flags >> 5:
+            raise ValueError(f'compact datagram with unknown flags {flags:#x}')
+        prices_as = struct.Struct('<%dd' % count)
+        keys_as = struct.Struct('<%d%s' % (count, COMPACT_KEY_FORMATS[key_format]))
+        offsets_as = struct.Struct('<%d%s' % (count, COMPACT_OFFSET_FORMATS[offset_format]))
+        codes_at = COMPACT_HEADER.size + prices_as.size + keys_as.size + offsets_as.size
+        if codes_at > len(message) or (len(message) - codes_at) % CODES_SIZE:
+            raise ValueError(f'compact datagram of {len(message)} bytes too short for its {count} quotes')
+        prices = prices_as.unpack_from(message, COMPACT_HEADER.size)
+        keys = keys_as.unpack_from(message, COMPACT_HEADER.size + prices_as.size)
+        offsets = offsets_as.unpack_from(message, codes_at - offsets_as.size)
+
+        if epoch != self.epoch:  # the publisher restarted, its ids stand for other crosses now
+            self.epoch = epoch
+            self.crosses = {}
+        crosses = self.crosses
+        if codes_at < len(message):  # crosses announced, in key order
+            announced = [key >> 1 for key in keys if key & 1]
+            if len(announced) * CODES_SIZE != len(message) - codes_at:
+                raise ValueError(f'compact datagram announces {len(announced)} crosses'
+                                 f' but has codes for {(len(message) - codes_at) // CODES_SIZE}')
+            for cross_id, at in zip(announced, range(codes_at, len(message), CODES_SIZE)):
+                crosses[cross_id] = (intern_currency(bytes(message[at:at + 3])),
+                                     intern_currency(bytes(message[at + 3:at + 6])))
+        get = crosses.get
+        quotes = [(base + offset, cross[0], cross[1], price)
+                  for cross, offset, price in zip([get(key >> 1) for key in keys], offsets, prices)
+                  if cross is not None]
+        self.unknown += count - len(quotes)
+        return quotes
+
+def micros_to_datetime(micros: int) -> datetime:
+    """Converts an int number of microseconds since the epoch into a UTC datetime"""
+    return EPOCH + timedelta(microseconds=micros)
+
 def unmarshal_message(message: bytes) -> list:
     """
     Unmarshals publisher message to retrive the needed information
@@ -41,21 +188,20 @@ def unmarshal_message(message: bytes) -> list:
     to be exchanged per one unit of currency1. So, for example, if currency1 is USD and currency2 is JPY,
     we'd expect the exchange rate to be around 100.
 
-    Bytes[22:32] Reserved. These are not currently used (typically all set to 0-bits).
+    Bytes[22:26] The publisher epoch, a 32-bit big-endian number identifying the publisher run
+    (0 if the publisher doesn't number its messages).
+
+    Bytes[26:30] The 32-bit big-endian sequence number of the message within that epoch.
+
+    Bytes[30:32] Reserved. These are not currently used (typically all set to 0-bits).
+
+    Each quote is returned as a dict with a datetime timestamp and the message epoch and
+    sequence, unmarshal_records is cheaper when the caller can work with int microseconds
     """
-    number_of_quotes = len(message) / SIZE_OF_ONE_MESSAGE
-    unmarshaled_quotes = []
-    for i in range(int(number_of_quotes)):
-        curr_quote = {}
-        curr_quote['timestamp']= deserialize_utcdatetime(message[(i*SIZE_OF_ONE_MESSAGE): ((i*SIZE_OF_ONE_MESSAGE)+8)])
-        currency_1 = message[((i*SIZE_OF_ONE_MESSAGE)+8):((i*SIZE_OF_ONE_MESSAGE)+11)].decode('utf-8')
-        currency_2 = message[((i*SIZE_OF_ONE_MESSAGE)+11):((i*SIZE_OF_ONE_MESSAGE)+14)].decode('utf-8')
-        curr_quote['curr1'] = currency_1
-        curr_quote['curr2'] = currency_2
-        curr_quote['price'] = deserialize_price(message[((i*SIZE_OF_ONE_MESSAGE) + 14) : ((i*SIZE_OF_ONE_MESSAGE) + 22)])
-
-        unmarshaled_quotes.append(curr_quote)
-    return unmarshaled_quotes
+    epoch, sequence = message_sequence(message)
+    return [{'timestamp': micros_to_datetime(timestamp), 'curr1': curr1, 'curr2': curr2, 'price': price,
+             'epoch': epoch, 'sequence': sequence}
+            for timestamp, curr1, curr2, price in unmarshal_records(message)]
 
 def deserialize_utcdatetime(utc_bytes: bytes) -> datetime:
     """ Converts a byte stream into  UTC datetime """
@@ -0,0 +1,85 @@
+"""
+Forex Provider Feed Capture
+This module records received forex datagrams to a binary file and reads them back.
+A capture file starts with CAPTURE_MAGIC followed by one record per datagram:
+Bytes[0:8] receive time, 64-bit little-endian microseconds since the epoch
+Bytes[8:12] datagram length, 32-bit little-endian
+then the datagram itself, exactly as it was received
+:Authors: Noha Nomier
+"""
+import mmap
+import struct
+import time
+
+CAPTURE_MAGIC = b'FXPCAP01'
+RECORD_HEADER = struct.Struct('<QI')
+MICROS_PER_SECOND = 1_000_000
+
+
+class FeedCapture:
+    """
+    Appends datagrams with their receive time to a capture file
+    """
+    def __init__(self, path):
+        self.file = open(path, 'ab')
+        if self.file.tell() == 0:
+            self.file.write(CAPTURE_MAGIC)
+
+    def write(self, datagram, received=None):
+        """appends @datagram received at @received (microseconds since the epoch, now by default)"""
+        if received is None:
+            received = int(time.time() * MICROS_PER_SECOND)
+        self.file.write(RECORD_HEADER.pack(received, len(datagram)))
+        self.file.write(datagram)
+
+    def close(self):
+        self.file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+class CaptureReader:
+    """
+    Memory-maps a capture file and iterates over its (receive time, datagram) records,
+    datagrams are memoryviews into the file so they must not be kept after the reader is closed
+
+    >>> import os, tempfile
+    >>> path = os.path.join(tempfile.mkdtemp(), 'feed.cap')
+    >>> with FeedCapture(path) as capture:
+    ...     capture.write(b'first', 10); capture.write(b'second', 20)
+    >>> with CaptureReader(path) as reader:
+    ...     [(received, bytes(datagram)) for received, datagram in reader]
+    [(10, b'first'), (20, b'second')]
+    """
+    def __init__(self, path):
+        with open(path, 'rb') as f:
+            self.map = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        if self.map[:len(CAPTURE_MAGIC)] != CAPTURE_MAGIC:
+            self.map.close()
+            raise ValueError(f'{path} is not a forex feed capture')
+        self.view = memoryview(self.map)
+
+    def __iter__(self):
+        offset = len(CAPTURE_MAGIC)
+        end = len(self.map)
+        while offset + RECORD_HEADER.size <= end:
+            received, length = RECORD_HEADER.unpack_from(self.map, offset)
+            offset += RECORD_HEADER.size
+            if offset + length > end:
+                break  # capture was cut off in the middle of a datagram
+            yield received, self.view[offset:offset + length]
+            offset += length
+
+    def close(self):
+        self.view.release()
+        self.map.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
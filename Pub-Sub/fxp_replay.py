@@ -0,0 +1,133 @@
+"""
+Forex Feed Replay
+Feeds a capture recorded with python3 lab3.py HOST PORT --capture FILE back into an
+ArbitrageSubscriber and reports detection throughput and latency.
+Run python3 fxp_replay.py FILE [SPEED] [--matrix] [--latency] [--verbose]
+SPEED is 1 (default) to replay at the recorded pace, N to replay N times faster,
+or max to feed the datagrams back to back, BATCH_SIZE at a time.
+With --latency the subscriber's stage latencies are reported too, against the recorded receive times
+:Authors: Noha Nomier
+"""
+import contextlib
+import os
+import sys
+import time
+
+from bellman_ford import MatrixBellmanFord
+from fxp_capture import CaptureReader, MICROS_PER_SECOND
+from lab3 import ArbitrageSubscriber, MAX_BATCH
+
+BATCH_SIZE = 1  # datagrams per batch when replaying at max speed
+
+
+class ReplayClock(object):
+    """
+    Stands in for the time module as the clock of a subscriber being replayed to, so
+    quotes expire as they did when recorded whatever the replay speed. Both time() and
+    monotonic() read the recorded receive time of the datagrams being handled, as set
+    by advance, plus the real time spent handling them since
+    """
+    def __init__(self):
+        self.recorded = 0.0
+        self.advanced_at = time.monotonic()
+
+    def advance(self, recorded):
+        """moves the clock to the @recorded time in seconds"""
+        self.recorded = recorded
+        self.advanced_at = time.monotonic()
+
+    def time(self):
+        return self.recorded + time.monotonic() - self.advanced_at
+
+    def monotonic(self):
+        return self.time()
+
+
+def percentile(ordered, fraction):
+    """returns the value at @fraction of the sorted list @ordered"""
+    return ordered[min(len(ordered) - 1, int(fraction * len(ordered)))]
+
+
+def replay(subscriber, reader, speed=1.0):
+    """
+    Feeds every datagram in @reader to @subscriber, @speed times faster than recorded
+    or back to back when @speed is None. Datagrams due together are handled as one batch,
+    like the subscriber does with a burst on its socket. The subscriber's clock is
+    replaced by a ReplayClock following the recorded times.
+    Returns (datagrams, quotes, seconds, batch latencies) where a batch latency runs from
+    the time its first datagram was due until arbitrage detection finished
+    """
+    records = iter(reader)
+    pending = next(records, None)
+    if pending is None:
+        return 0, 0, 0.0, []
+    first_received = pending[0]
+    datagrams = quotes = 0
+    latencies = []
+    clock = subscriber.clock = ReplayClock()
+    start = time.monotonic()
+    while pending is not None:
+        received, datagram = pending
+        due = start if speed is None else start + (received - first_received) / MICROS_PER_SECOND / speed
+        delay = due - time.monotonic()
+        if delay > 0:
+            time.sleep(delay)
+        batch = [datagram]
+        times = [received]
+        pending = next(records, None)
+        limit = BATCH_SIZE if speed is None else MAX_BATCH
+        while pending is not None and len(batch) < limit and (
+                speed is None or start + (pending[0] - first_received) / MICROS_PER_SECOND / speed
+                <= time.monotonic()):
+            received, datagram = pending
+            batch.append(datagram)
+            times.append(received)
+            pending = next(records, None)
+
+        # quotes age from when they were recorded as received, not from when they are replayed
+        clock.advance(received / MICROS_PER_SECOND)
+        if subscriber.latency is not None:
+            for at in times:
+                subscriber.latency.received(at / MICROS_PER_SECOND)
+        began = time.monotonic() if speed is None else due
+        decoded = subscriber.received
+        subscriber.handle_datagrams(batch)
+        latencies.append(time.monotonic() - began)
+        datagrams += len(batch)
+        quotes += subscriber.received - decoded
+        del batch, datagram  # views into the capture, released before the reader closes
+    return datagrams, quotes, time.monotonic() - start, latencies
+
+
+def report(datagrams, quotes, seconds, latencies):
+    print(f"replayed {datagrams} datagrams, {quotes} quotes in {seconds:.3f}s"
+          f" ({datagrams / seconds:.0f} datagrams/s, {quotes / seconds:.0f} quotes/s)")
+    ordered = sorted(latencies)
+    print(f"{len(ordered)} batches, detection latency (ms)"
+          f" p50 {percentile(ordered, 0.5) * 1e3:.3f}"
+          f" p99 {percentile(ordered, 0.99) * 1e3:.3f}"
+          f" max {ordered[-1] * 1e3:.3f}")
+
+
+if __name__ == "__main__":
+    arguments = [argument for argument in sys.argv[1:] if not argument.startswith('--')]
+    if len(arguments) not in (1, 2):
+        print("Please enter valid command i.e python3 fxp_replay.py FILE [SPEED|max] [--matrix] [--verbose] [--latency]")
+        exit(1)
+
+    speed = 1.0
+    if len(arguments) == 2:
+        speed = None if arguments[1] == 'max' else float(arguments[1])
+    graph = MatrixBellmanFord() if '--matrix' in sys.argv else None
+    subscriber = ArbitrageSubscriber(None, graph, latency='--latency' in sys.argv)
+    with CaptureReader(arguments[0]) as reader:
+        # the subscriber prints every quote, which would be most of what gets measured
+        with open(os.devnull, 'w') as devnull:
+            with contextlib.redirect_stdout(sys.stdout if '--verbose' in sys.argv else devnull):
+                results = replay(subscriber, reader, speed)
+    if results[0] == 0:
+        print("capture is empty")
+    else:
+        report(*results)
+        if subscriber.latency is not None:
+            print(subscriber.latency.report())
@@ -6,25 +6,67 @@ Lab3: Pub/Sub
 """
 import sys
 import socket
-from datetime import datetime
-from bellman_ford import BellmanFord
+import selectors
+import time
+import heapq
+from bellman_ford import DynamicBellmanFord, MatrixBellmanFord, profitable_cycles
 import fxp_bytes_subscriber
+from fxp_capture import FeedCapture
+from latency import PipelineLatency
 import math
 
 LISTENER_ADDRESS = (socket.gethostbyname(socket.gethostname()), 0)
+MULTICAST_GROUP = None  # set to the provider's forex_provider_v2.MULTICAST_GROUP to receive its multicast feed
 BUFF_SIZE = 4096
 QUOTE_TIMEOUT = 1.5
+MICROS_PER_SECOND = 1_000_000
+MAX_CYCLE_LENGTH = 4  # longest arbitrage cycle (in currencies) considered for trading
+TRADING_FEE = 0.0  # fraction of the amount paid on every exchange
+MIN_PROFIT = 0.001  # fraction a cycle must gain after fees to be worth trading, well above the drift between quotes
+DETECTION_LATENCY = 0.0  # seconds to keep batching datagrams after the first one before detecting
+MAX_BATCH = 1000  # most datagrams applied in one batch
+DETECTION_POLL = 0.005  # seconds between checks for the results of a parallel detection
+SEQUENCE_MODULUS = 2**32  # datagram sequence numbers wrap around to 0 at this
 
 class ArbitrageSubscriber:
     """
     Constructs an Arbitrage Subscriber Object to listen to published messages
     and detect arbitrage ooportunities
     """
-    def __init__(self, provider_address):
+    def __init__(self, provider_address, graph=None, capture=None, detector=None, latency=False,
+                 fee=TRADING_FEE, min_profit=MIN_PROFIT):
+        """
+        :param provider_address: (host, port) of the forex provider
+        :param graph: arbitrage engine to use, DynamicBellmanFord by default,
+                      MatrixBellmanFord is faster with hundreds of currencies
+        :param capture: FeedCapture every received datagram is recorded to, for fxp_replay.py
+        :param detector: ParallelDetector ranking the cycles in worker processes, its graph is used
+        :param latency: measure and periodically report how long quotes take through each stage
+        :param fee: fraction of the amount paid on every exchange
+        :param min_profit: fraction a cycle must gain after fees to be worth trading
+        """
         self.provider_address = provider_address
-        self.quotes_timestamps = {}  # key is curr1, val is {curr2: timestamp, curr3: timestamp, ...}
-        self.graph = BellmanFord()
-        self.lastest_timestamp = datetime.now()
+        self.fee = fee
+        self.min_profit = min_profit
+        self.quote_deadlines = {}  # (curr1, curr2) in alphabetical order -> time.monotonic() the quote goes stale
+        self.expiries = []  # heap of (deadline, cross), entries whose deadline moved on are skipped
+        self.detector = detector
+        if detector is not None:
+            graph = detector.graph
+        self.graph = graph if graph is not None else DynamicBellmanFord()
+        self.latest_quotes = {}  # (curr1, curr2) in alphabetical order -> timestamp of the quote applied
+        self.feed_epoch = 0  # epoch of the publisher run the sequence numbers below belong to
+        self.last_sequence = 0  # latest datagram sequence number seen in that epoch, in wrapping order
+        self.missed = 0  # datagrams skipped over by the sequence numbers, lost or still to come
+        self.late = 0  # datagrams arriving after a higher sequence number, reordered or duplicated
+        self.corrupt = 0  # datagrams dropped because they couldn't be decoded
+        self.decoder = fxp_bytes_subscriber.DeltaDecoder()  # decodes both the plain and the compact feed
+        self.received = 0  # quotes decoded so far
+        self.capture = capture
+        # time() and monotonic() that quotes are aged by, a replay swaps in a clock running on the recorded times
+        self.clock = time
+        # stage timing is off unless asked for, then it runs on the same clock as the quotes
+        self.latency = PipelineLatency(clock=lambda: self.clock.time()) if latency else None
 
     def run(self):
         """
@@ -32,71 +74,140 @@ class ArbitrageSubscriber:
         the publisher and handles received quotes by checking arbitrage opportunities
         """
         with socket.socket(socket.AF_INET, socket.SOCK_DGRAM) as subscriber:
-            subscriber.bind(LISTENER_ADDRESS)
-            listener_address = subscriber.getsockname()
+            if MULTICAST_GROUP is not None:
+                subscriber.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+                subscriber.bind(('', MULTICAST_GROUP[1]))
+                membership = socket.inet_aton(MULTICAST_GROUP[0]) + socket.inet_aton(LISTENER_ADDRESS[0])
+                subscriber.setsockopt(socket.IPPROTO_IP, socket.IP_ADD_MEMBERSHIP, membership)
+                listener_address = (LISTENER_ADDRESS[0], MULTICAST_GROUP[1])
+            else:
+                subscriber.bind(LISTENER_ADDRESS)
+                listener_address = subscriber.getsockname()
             print( f'starting up on {listener_address[0]} port {listener_address[1]}')
 
             serailized_address = fxp_bytes_subscriber.serialize_address(listener_address[0], listener_address[1])
             subscriber.sendto(serailized_address, self.provider_address)
 
-            while True:
+            subscriber.setblocking(False)
+            with selectors.DefaultSelector() as selector:
+                selector.register(subscriber, selectors.EVENT_READ)
+                while True:
+                    # while workers are ranking cycles, wake up now and then to collect them
+                    busy = self.detector is not None and self.detector.outstanding
+                    selector.select(DETECTION_POLL if busy else None)
+                    self.handle_datagrams(self.receive_batch(subscriber, selector))
+
+    def receive_batch(self, subscriber, selector):
+        """
+        Reads every datagram already waiting on the non-blocking @subscriber socket.
+        With a DETECTION_LATENCY, keeps waiting for more until that long after the first
+        one, so bursts are applied together and arbitrage is checked once per batch
+        """
+        datagrams = []
+        deadline = time.monotonic() + DETECTION_LATENCY
+        while len(datagrams) < MAX_BATCH:
+            try:
                 data_bytes, _ = subscriber.recvfrom(BUFF_SIZE)
-                unmarshaled_data = fxp_bytes_subscriber.unmarshal_message(data_bytes)
-                self.remove_outdated_quotes()
-                self.handle_quotes_to_graph(unmarshaled_data)
-                self.detect_arbitrage()
+                datagrams.append(data_bytes)
+                if self.latency is not None:
+                    self.latency.received()
+                if self.capture is not None:
+                    self.capture.write(data_bytes)
+                continue
+            except BlockingIOError:
+                pass
+            remaining = deadline - time.monotonic()
+            if remaining <= 0 or not selector.select(remaining):
+                break
+        return datagrams
+
+    def handle_datagrams(self, datagrams):
+        """Applies all the quotes in @datagrams to the graph then checks for arbitrage once"""
+        latency = self.latency
+        quotes = []
+        for data_bytes in datagrams:
+            try:
+                decoded = self.decoder.decode(data_bytes)
+            except ValueError as e:  # truncated or corrupt, its sequence number can't be trusted either
+                self.corrupt += 1
+                print(f'dropping datagram: {e} ({self.corrupt} so far)')
+                if latency is not None:
+                    latency.dropped()
+                continue
+            self.track_sequence(data_bytes)
+            if latency is not None:
+                latency.decoded(decoded)
+            quotes.extend(decoded)
+        self.received += len(quotes)
+        self.remove_outdated_quotes()
+        self.handle_quotes_to_graph(quotes)
+        if latency is None:
+            return self.detect_arbitrage()
+        latency.applied()
+        cycle = self.detect_arbitrage()
+        latency.detected()
+        latency.maybe_report()
+        return cycle
+
+    def track_sequence(self, data_bytes):
+        """
+        Checks the datagram sequence number against the last one seen to count lost
+        and reordered datagrams, a new epoch means the publisher restarted.
+        Sequence numbers wrap around, so they are compared by their distance modulo
+        SEQUENCE_MODULUS: half the range or more ahead counts as behind
+        """
+        epoch, sequence = fxp_bytes_subscriber.message_sequence(data_bytes)
+        if epoch == 0:
+            return  # the publisher doesn't number its datagrams
+        if epoch != self.feed_epoch:
+            self.feed_epoch, self.last_sequence = epoch, sequence
+            return
+        ahead = (sequence - self.last_sequence) % SEQUENCE_MODULUS
+        if ahead == 0 or ahead >= SEQUENCE_MODULUS // 2:
+            self.late += 1
+            print(f'datagram #{sequence} arrived after #{self.last_sequence} ({self.late} so far)')
+            return
+        if ahead > 1:
+            self.missed += ahead - 1
+            print(f'gap in feed: {ahead - 1} datagrams missing before #{sequence} ({self.missed} so far)')
+        self.last_sequence = sequence
 
     def detect_arbitrage(self):
         """
-        Checks arbitrage opportunity by calling Bellman Ford shortest path algorithm to 
-        detect negative cycles, if there's a negative cycle then there's an arbitrage
+        Checks arbitrage opportunity by re-relaxing the graph from the edges changed
+        since the last check to detect negative cycles, if there's a negative cycle
+        then there's an arbitrage. The most profitable cycle worth trading is then
+        searched for and reported. With a detector the search runs in its workers and
+        is reported by whichever later call finds it complete
         """
-        for node in self.graph.get_nodes():
-            distances, predecessor, negative_edge = self.graph.shortest_paths( node, 1e-9)
-            if negative_edge is not None:
-                cycle = self.get_cycle(negative_edge, predecessor)
-                if cycle is not None:
-                    break
+        if self.detector is not None:
+            self.detector.submit(1e-9)
+            return self.report_cycles(self.detector.poll())
+        if self.graph.detect_negative_cycle(1e-9) is None:
+            return None
+        return self.report_cycles(profitable_cycles(self.graph.get_graph(), MAX_CYCLE_LENGTH, self.fee,
+                                                    self.min_profit, limit=1))
 
-    def get_cycle(self, negative_edge, predecessor, start_amount=100):
+    def report_cycles(self, opportunities):
+        """prints the best of the (profit, cycle) @opportunities and returns its cycle"""
+        if not opportunities:
+            return None
+        profit, cycle = opportunities[0]
+        if self.latency is not None:
+            crosses = [(u, v) if u < v else (v, u) for u, v in zip(cycle, cycle[1:])]
+            self.latency.signalled(max(self.latest_quotes.get(cross, 0) for cross in crosses))
+        print(f'best arbitrage cycle makes {profit:.6%}')
+        self.print_cycle(cycle)
+        return cycle
+
+    def print_cycle(self, cycle, start_amount=100):
         """
-        After detecting the existance of a negative cycle,
-        we need to retrieve the exact cycle and print out the path 
-        that be taken from the starting currency
+        Prints the exchanges along @cycle, a list of currencies starting and
+        ending with the same one, starting with @start_amount of it
         """
         graph = self.graph.get_graph()
-        cycle = []
-        # start with an arbitrary node in the cycle
-        cycle_node = negative_edge[1]
-        v = cycle_node
-
-        # set to see which currency is duplicated in the cycle to know what currency to start at
-        seen = {v}
-        start = None
-        while True:
-            v = predecessor[v]
-            if v is None:
-                return None
-            if v in seen:  # this would be the start of our cycle
-                start = v
-                break
-            seen.add(v)
-
         print(f'ARBITRAGE DETECTED:')
-        print(f"\tstart with {start} {str(start_amount)}")
-        v = start
-        while True:
-            if v is None:
-                return None
-            cycle.append(v)
-
-            # we've reached the end of the cycle
-            if v == start and len(cycle) > 1:
-                break
-            v = predecessor[v]
-
-        cycle.reverse()
-
+        print(f"\tstart with {cycle[0]} {str(start_amount)}")
         amount_exchanged = start_amount
 
         for i in range(0, len(cycle) - 1):
@@ -105,60 +216,80 @@ class ArbitrageSubscriber:
             print(f'\texchange {cycle[i]} for {cycle[i+1]} at {price} --> {cycle[i+1]}  {str(amount_exchanged)}')
 
         print('\n')
-        return cycle
 
     def remove_outdated_quotes(self):
         """
-        Removes any published quotes that exceeded QUOTE_TIMEOUT
-        """
-        curr_utc_time = datetime.utcnow()
-        temp = {}
-        for curr1, val_dict in self.quotes_timestamps.items():
-            for curr2, last_timestamp in val_dict.items():
-                if (curr_utc_time - last_timestamp).total_seconds() > QUOTE_TIMEOUT:
-                    print(
-                        f'removing stale quote for (\'{curr1}\', \'{curr2}\')')
-                    self.graph.remove_edge(curr1, curr2)
-                else:
-                    if curr1 not in temp.keys():
-                        temp[curr1] = {
-                            curr2: self.quotes_timestamps[curr1][curr2]}
-                    else:
-                        temp[curr1][curr2] = self.quotes_timestamps[curr1][curr2]
-
-        self.quotes_timestamps = temp
+        Removes any published quotes that exceeded QUOTE_TIMEOUT, only the quotes
+        due to expire are looked at, from the front of the expiry heap
+        """
+        now = self.clock.monotonic()
+        while self.expiries and self.expiries[0][0] < now:
+            deadline, cross = heapq.heappop(self.expiries)
+            if self.quote_deadlines.get(cross) != deadline:
+                continue  # a newer quote for this cross has replaced this one
+            del self.quote_deadlines[cross]
+            del self.latest_quotes[cross]
+            print(f'removing stale quote for {cross}')
+            self.graph.remove_edge(*cross)
 
     def handle_quotes_to_graph(self, received_quotes):
         """
         Handles received quotes from publisher by adding them to the graph 
-        or updating values if they already existed and removing any out-of-sequence
-        message
+        or updating values if they already existed. A quote older than the one already
+        applied for the same cross, or already stale, is ignored, quotes are
+        (timestamp, curr1, curr2, price) records
         """
-        for quote in received_quotes:
-            quote_time = quote['timestamp']
-            curr1 = quote['curr1']
-            curr2 = quote['curr2']
-            rate = quote['price']
-            print(f'{str(quote_time)} {curr1} {curr2} {str(rate)}')
+        # a quote published at t goes stale at t + QUOTE_TIMEOUT, moved onto the monotonic clock
+        now = self.clock.monotonic()
+        monotonic_offset = now - self.clock.time()
+        for quote_time, curr1, curr2, rate in received_quotes:
+            print(f'{str(fxp_bytes_subscriber.micros_to_datetime(quote_time))} {curr1} {curr2} {str(rate)}')
 
-            if self.lastest_timestamp > quote_time:
+            cross = (curr1, curr2) if curr1 < curr2 else (curr2, curr1)
+            deadline = quote_time / MICROS_PER_SECOND + monotonic_offset + QUOTE_TIMEOUT
+            if self.latest_quotes.get(cross, 0) > quote_time:
                 print('ignoring out-of-sequence message')
+            elif deadline < now:
+                print('ignoring stale quote')
             else:
                 self.graph.add_edge(curr1, curr2, rate)
-
-                if curr1 not in self.quotes_timestamps.keys():
-                    self.quotes_timestamps[curr1] = {curr2: quote_time}
-                else:
-                    self.quotes_timestamps[curr1][curr2] = quote_time
-
-                self.lastest_timestamp = quote_time
+                self.latest_quotes[cross] = quote_time
+                self.quote_deadlines[cross] = deadline
+                heapq.heappush(self.expiries, (deadline, cross))
 
 
 if __name__ == "__main__":
-    if len(sys.argv) != 3:
-        print("Please enter valid command i.e python3 lab2.py [PROVIDER_HOST] [PROVIDER_PORT]")
+    options = sys.argv[3:]
+    values = {}  # option taking a value -> its value, None if it is missing
+    for name in ('--capture', '--fee', '--min-profit'):
+        if name in options:
+            at = options.index(name)
+            values[name] = options[at + 1] if at + 1 < len(options) else None
+            del options[at:at + 2]
+    try:
+        fee = float(values.get('--fee', TRADING_FEE))
+        min_profit = float(values.get('--min-profit', MIN_PROFIT))
+    except (TypeError, ValueError):
+        fee = None
+    if len(sys.argv) < 3 or not set(options) <= {'--matrix', '--parallel', '--latency'} or (
+            None in values.values()) or fee is None or not 0 <= fee < 1:
+        print("Please enter valid command i.e python3 lab3.py [PROVIDER_HOST] [PROVIDER_PORT] [--matrix]"
+              " [--parallel] [--latency] [--capture FILE] [--fee FRACTION] [--min-profit FRACTION]")
         exit(1)
 
     address = (sys.argv[1], int(sys.argv[2]))
-    subscriber = ArbitrageSubscriber(address)
-    subscriber.run()
+    graph = MatrixBellmanFord() if '--matrix' in options else None
+    detector = None
+    if '--parallel' in options:
+        from parallel_detection import ParallelDetector  # needs numpy
+        detector = ParallelDetector(max_length=MAX_CYCLE_LENGTH, fee=fee, min_profit=min_profit, limit=1)
+    capture = FeedCapture(values['--capture']) if '--capture' in values else None
+    subscriber = ArbitrageSubscriber(address, graph, capture, detector, latency='--latency' in options,
+                                     fee=fee, min_profit=min_profit)
+    try:
+        subscriber.run()
+    finally:
+        if capture is not None:
+            capture.close()
+        if detector is not None:
+            detector.close()
@@ -0,0 +1,166 @@
+"""
+Pub/Sub Latency
+Measures how long quotes take to go through the subscriber pipeline, from the
+timestamp the publisher put on them to the arbitrage they trigger being reported.
+Latencies are kept in log-linear histograms (as in HdrHistogram): every power of
+two is split into equal sub-buckets, so each value is off by at most 1/SUB_BUCKETS
+whatever its magnitude and recording one is a couple of integer operations.
+:Authors: Noha Nomier
+"""
+import time
+from collections import deque
+
+SUB_BITS = 5  # 2**(SUB_BITS - 1) sub-buckets per power of two, about 6% precision
+SUB_BUCKETS = 1 << (SUB_BITS - 1)
+REPORT_INTERVAL = 5.0  # seconds between reports
+MICROS_PER_SECOND = 1_000_000
+# network: publisher timestamp to datagram received, per quote (includes clock skew between the hosts)
+# decode: datagram received to decoded, per datagram (includes waiting for the rest of its batch)
+# graph: datagram decoded to its batch applied to the graph, per datagram
+# detect: batch applied to arbitrage detection done, per batch
+# signal: newest quote of a reported cycle to the report, per arbitrage reported
+STAGES = ('network', 'decode', 'graph', 'detect', 'signal')
+
+
+def bucket_index(value):
+    """
+    Returns the bucket of the non-negative int @value
+
+    >>> [bucket_index(v) for v in (0, 31, 32, 33, 34, 1000, 1023, 1024)]
+    [0, 31, 32, 32, 33, 111, 111, 112]
+    """
+    if value < 2 * SUB_BUCKETS:
+        return value
+    shift = value.bit_length() - SUB_BITS
+    return (shift << (SUB_BITS - 1)) + (value >> shift)
+
+
+def bucket_lowest(index):
+    """
+    Returns the smallest value that falls in bucket @index
+
+    >>> [bucket_lowest(i) for i in (31, 32, 33, 111, 112)]
+    [31, 32, 34, 992, 1024]
+    """
+    if index < 2 * SUB_BUCKETS:
+        return index
+    shift = (index >> (SUB_BITS - 1)) - 1
+    return (index - (shift << (SUB_BITS - 1))) << shift
+
+
+class LatencyHistogram(object):
+    """
+    Counts int latencies (microseconds) in log-linear buckets
+
+    >>> histogram = LatencyHistogram()
+    >>> for micros in range(1, 1001):
+    ...     histogram.record(micros)
+    >>> histogram.count, histogram.value_at(50), histogram.value_at(99), histogram.max
+    (1000, 511, 991, 1000)
+    """
+    def __init__(self):
+        self.counts = []
+        self.count = 0
+        self.total = 0
+        self.max = 0
+
+    def record(self, micros):
+        """counts @micros, negative values (clocks out of step) count as 0"""
+        micros = max(0, int(micros))
+        index = bucket_index(micros)
+        if index >= len(self.counts):
+            self.counts.extend([0] * (index + 1 - len(self.counts)))
+        self.counts[index] += 1
+        self.count += 1
+        self.total += micros
+        if micros > self.max:
+            self.max = micros
+
+    def value_at(self, percentile):
+        """returns the highest value of the bucket holding the @percentile-th percentile"""
+        wanted = max(1, -(-self.count * percentile // 100))
+        seen = 0
+        for index, count in enumerate(self.counts):
+            seen += count
+            if seen >= wanted:
+                return min(self.max, bucket_lowest(index + 1) - 1)
+        return self.max
+
+    def mean(self):
+        return self.total / self.count if self.count else 0
+
+
+class PipelineLatency(object):
+    """
+    Collects the STAGES latencies of an ArbitrageSubscriber, which calls received,
+    decoded, applied, detected and signalled as quotes go through it, and reports
+    them every @report_interval seconds. @clock gives the wall-clock time in seconds
+    the stages are measured with, quote timestamps are compared against it
+    """
+    def __init__(self, report_interval=REPORT_INTERVAL, clock=time.time):
+        self.clock = clock
+        self.report_interval = report_interval
+        self.histograms = {stage: LatencyHistogram() for stage in STAGES}
+        self.counters = dict.fromkeys(('datagrams', 'quotes', 'batches', 'signals'), 0)
+        self.receive_times = deque()  # receive time of each datagram not decoded yet
+        self.decode_times = []  # decode time of each datagram of the batch being handled
+        self.applied_time = None
+        self.next_report = time.monotonic() + report_interval
+
+    def received(self, at=None):
+        """a datagram was received @at (now by default)"""
+        self.receive_times.append(self.clock() if at is None else at)
+
+    def decoded(self, quotes):
+        """the next datagram received was decoded into the (timestamp, curr1, curr2, price) @quotes"""
+        now = self.clock()
+        received = self.receive_times.popleft() if self.receive_times else now
+        network = self.histograms['network']
+        received_micros = int(received * MICROS_PER_SECOND)
+        for quote in quotes:
+            network.record(received_micros - quote[0])
+        self.histograms['decode'].record((now - received) * MICROS_PER_SECOND)
+        self.decode_times.append(now)
+        self.counters['datagrams'] += 1
+        self.counters['quotes'] += len(quotes)
+
+    def dropped(self):
+        """the next datagram received was dropped undecoded"""
+        if self.receive_times:
+            self.receive_times.popleft()
+
+    def applied(self):
+        """the datagrams decoded since the last batch were applied to the graph"""
+        now = self.applied_time = self.clock()
+        graph = self.histograms['graph']
+        for decoded in self.decode_times:
+            graph.record((now - decoded) * MICROS_PER_SECOND)
+        self.decode_times.clear()
+
+    def detected(self):
+        """arbitrage detection finished for the batch"""
+        now = self.clock()
+        if self.applied_time is not None:
+            self.histograms['detect'].record((now - self.applied_time) * MICROS_PER_SECOND)
+        self.counters['batches'] += 1
+
+    def signalled(self, newest_quote):
+        """an arbitrage was reported whose newest quote has timestamp @newest_quote (microseconds)"""
+        self.histograms['signal'].record(self.clock() * MICROS_PER_SECOND - newest_quote)
+        self.counters['signals'] += 1
+
+    def maybe_report(self):
+        """prints the report if it is due"""
+        now = time.monotonic()
+        if now >= self.next_report:
+            self.next_report = now + self.report_interval
+            print(self.report())
+
+    def report(self):
+        """returns the counters and a line of percentiles (microseconds) per stage"""
+        lines = ['latency (us): ' + ', '.join(f'{count} {name}' for name, count in self.counters.items()),
+                 f"{'stage':<10}{'count':>10}{'mean':>10}{'p50':>10}{'p90':>10}{'p99':>10}{'max':>10}"]
+        for stage, histogram in self.histograms.items():
+            lines.append(f'{stage:<10}{histogram.count:>10}{histogram.mean():>10.0f}{histogram.value_at(50):>10}'
+                         f'{histogram.value_at(90):>10}{histogram.value_at(99):>10}{histogram.max:>10}')
+        return '\n'.join(lines)
@@ -0,0 +1,177 @@
+"""
+Parallel Arbitrage Detection
+Ranks arbitrage cycles in worker processes so the subscriber's receive loop keeps
+taking quotes in while a slow enumeration runs. The -log(price) weight matrix lives
+in shared memory: the receive loop writes quotes straight into it and the workers
+read it from there, nothing is copied per detection. Cycles are enumerated by the
+currency they start from, in partitions the workers take from a task queue, and come
+back through a result queue to be checked against the latest prices. Needs numpy.
+:Authors: Noha Nomier
+"""
+import math
+import multiprocessing
+import queue
+from multiprocessing import shared_memory
+
+from bellman_ford import MatrixBellmanFord, matrix_graph, profitable_cycles, np
+
+DETECTION_WORKERS = max(1, multiprocessing.cpu_count() - 1)  # one core is left to the receive loop
+PARTITIONS_PER_WORKER = 4  # more partitions than workers evens out the uneven cost of start currencies
+SHARED_CAPACITY = 256  # currencies the shared matrix holds before it is moved to a bigger block
+
+
+class SharedMatrixBellmanFord(MatrixBellmanFord):
+    """
+    MatrixBellmanFord whose weight matrix is kept in a named shared memory block,
+    so other processes can attach to it by name
+    """
+    def __init__(self, capacity=SHARED_CAPACITY):
+        super().__init__(capacity)
+        self.memory = None
+        self.weights = self.share(self.weights)
+
+    def share(self, weights):
+        """copies @weights into a new shared memory block, which replaces the previous one"""
+        memory = shared_memory.SharedMemory(create=True, size=weights.nbytes)
+        shared = np.ndarray(weights.shape, dtype=weights.dtype, buffer=memory.buf)
+        shared[:] = weights
+        self.release()
+        self.memory = memory
+        return shared
+
+    def currency_id(self, curr):
+        """returns the id of @curr, a matrix grown for a new currency is moved back to shared memory"""
+        capacity = len(self.degree)
+        curr_id = super().currency_id(curr)
+        if len(self.degree) != capacity:
+            self.weights = self.share(self.weights)
+        return curr_id
+
+    def release(self):
+        """unlinks the shared memory block, the matrix must no longer be in it"""
+        if self.memory is not None:
+            self.memory.close()
+            self.memory.unlink()
+            self.memory = None
+
+    def close(self):
+        self.weights = np.array(self.weights)  # back to private memory before the block goes
+        self.release()
+
+
+def detection_worker(tasks, results):
+    """
+    Worker process loop: takes (block name, matrix shape, currencies, start currencies,
+    (max_length, fee, min_profit, limit), generation) tasks until it gets None and puts
+    (generation, profitable cycles starting from those currencies) results, only the
+    limit best of them when there is a limit so the results queue doesn't pickle them all
+    """
+    memory = None
+    graph, graph_of = None, None  # the graph built for the last generation, shared by its partitions
+    for name, shape, names, starts, settings, generation in iter(tasks.get, None):
+        if graph_of != (name, generation):
+            try:
+                if memory is None or memory.name != name:
+                    if memory is not None:
+                        memory.close()
+                    memory = shared_memory.SharedMemory(name=name)
+            except FileNotFoundError:  # the matrix moved to a bigger block since this was queued
+                memory = None
+                results.put((generation, []))
+                continue
+            weights = np.ndarray(shape, dtype=np.float64, buffer=memory.buf)
+            graph, graph_of = matrix_graph(weights, names), (name, generation)
+            del weights
+        max_length, fee, min_profit, limit = settings
+        results.put((generation, profitable_cycles(graph, max_length, fee, min_profit, starts, limit)))
+    if memory is not None:
+        memory.close()
+
+
+class ParallelDetector(object):
+    """
+    Runs profitable_cycles over the shared matrix of @graph (a SharedMatrixBellmanFord)
+    on @workers processes. The caller updates @graph as usual and calls submit after
+    each batch of quotes, then poll for the ranked cycles once all partitions are back.
+    Only one detection runs at a time, a submit while one is running is ignored.
+    With @limit each partition only sends back its @limit best cycles, and poll the
+    @limit best of those.
+    """
+    def __init__(self, workers=DETECTION_WORKERS, max_length=4, fee=0.0, min_profit=0.0,
+                 capacity=SHARED_CAPACITY, limit=None):
+        if not 0 <= fee < 1:
+            raise ValueError('fee must be a fraction in [0, 1)')
+        self.graph = SharedMatrixBellmanFord(capacity)
+        self.settings = (max_length, fee, min_profit, limit)
+        self.limit = limit
+        self.partitions = workers * PARTITIONS_PER_WORKER
+        self.tasks = multiprocessing.Queue()
+        self.results = multiprocessing.Queue()
+        self.workers = [multiprocessing.Process(target=detection_worker, args=(self.tasks, self.results), daemon=True)
+                        for _ in range(workers)]
+        for worker in self.workers:
+            worker.start()
+        self.generation = 0  # number of the detection running, results of older ones are dropped
+        self.outstanding = 0  # partitions of the running detection not back yet
+        self.found = []
+
+    def submit(self, tolerance=0):
+        """
+        Starts ranking cycles in the workers if the graph has a negative cycle and no
+        detection is running, returns whether one was started. The negative cycle check
+        is MatrixBellmanFord's, warm and vectorized, so it stays on the caller's thread
+        """
+        if self.outstanding or self.graph.detect_negative_cycle(tolerance) is None:
+            return False
+        names = list(self.graph.names)
+        order = sorted(names)
+        count = min(len(order), self.partitions)
+        self.generation += 1
+        for i in range(count):
+            # every count-th currency, as the first ones in order have the most cycles to enumerate
+            self.tasks.put((self.graph.memory.name, self.graph.weights.shape, names, order[i::count],
+                            self.settings, self.generation))
+        self.outstanding = count
+        self.found = []
+        return True
+
+    def poll(self, timeout=None):
+        """
+        Collects the results of the running detection without blocking (or waiting up to
+        @timeout seconds). Returns None while some are missing, otherwise the (profit, cycle)
+        pairs still profitable at the latest prices, best first
+        """
+        while self.outstanding:
+            try:
+                generation, cycles = self.results.get(timeout=timeout) if timeout else self.results.get_nowait()
+            except queue.Empty:
+                return None
+            if generation == self.generation:
+                self.found.extend(cycles)
+                self.outstanding -= 1
+        if not self.found:
+            return None
+        found, self.found = self.found, []
+        return self.verify(found)[:self.limit]
+
+    def verify(self, found):
+        """reprices the cycles in @found with the current weights, prices kept moving while they were enumerated"""
+        max_length, fee, min_profit, limit = self.settings
+        fee_cost = -1 * math.log(1 - fee)
+        threshold = -1 * math.log(1 + min_profit)
+        weights, ids = self.graph.weights, self.graph.ids
+        cycles = []
+        for _, cycle in found:
+            total = sum(weights[ids[u], ids[v]] + fee_cost for u, v in zip(cycle, cycle[1:]))
+            if total < threshold:
+                cycles.append((math.exp(-1 * total) - 1, cycle))
+        cycles.sort(key=lambda verified: verified[0], reverse=True)
+        return cycles
+
+    def close(self):
+        """stops the workers and frees the shared matrix"""
+        for _ in self.workers:
+            self.tasks.put(None)
+        for worker in self.workers:
+            worker.join()
+        self.graph.close()